@@ -0,0 +1,395 @@
+#!/usr/bin/env python3
+
+""" Deterministic synthetic data for benchmarking the python scripts in bin/.
+
+Generates AlphaFold style mmCIF and PDB files, a fake `targetp` executable,
+and sniffles2 style BND VCFs with a matching fasta.
+"""
+
+import os
+import random
+import gzip
+from os.path import join as pjoin
+
+
+AMINO_ACIDS = "ACDEFGHIKLMNPQRSTVWY"
+
+THREE_LETTER = {
+    "A": "ALA", "C": "CYS", "D": "ASP", "E": "GLU", "F": "PHE",
+    "G": "GLY", "H": "HIS", "I": "ILE", "K": "LYS", "L": "LEU",
+    "M": "MET", "N": "ASN", "P": "PRO", "Q": "GLN", "R": "ARG",
+    "S": "SER", "T": "THR", "V": "VAL", "W": "TRP", "Y": "TYR",
+}
+
+# A cut down set of atoms per residue, enough to look like a real file.
+BACKBONE_ATOMS = [("N", "N"), ("CA", "C"), ("C", "C"), ("O", "O"), ("CB", "C")]
+
+PLDDT_PROFILES = ["ends", "high", "low", "noisy"]
+
+ATOM_SITE_COLUMNS = [
+    "group_PDB", "id", "type_symbol", "label_atom_id", "label_alt_id",
+    "label_comp_id", "label_asym_id", "label_entity_id", "label_seq_id",
+    "pdbx_PDB_ins_code", "Cartn_x", "Cartn_y", "Cartn_z", "occupancy",
+    "B_iso_or_equiv", "pdbx_formal_charge", "auth_seq_id", "auth_comp_id",
+    "auth_asym_id", "auth_atom_id", "pdbx_PDB_model_num",
+]
+
+
+def random_protein(length, rng):
+    return "M" + "".join(rng.choice(AMINO_ACIDS) for _ in range(length - 1))
+
+
+def plddt_profile(length, rng, kind="ends"):
+    """ Per-residue pLDDT values rounded to 2dp like AlphaFold files.
+
+    "ends" has disordered termini and a confident core,
+    "high" and "low" are confident or not throughout,
+    and "noisy" alternates between the two.
+    """
+    if kind == "ends":
+        left = rng.randint(0, length // 3)
+        right = rng.randint(0, length // 3)
+        values = [
+            rng.uniform(20, 75) if (i < left or i >= length - right) else rng.uniform(60, 98)
+            for i in range(length)
+        ]
+    elif kind == "high":
+        values = [rng.uniform(70, 98) for _ in range(length)]
+    elif kind == "low":
+        values = [rng.uniform(20, 72) for _ in range(length)]
+    elif kind == "noisy":
+        values = [rng.choice([rng.uniform(20, 60), rng.uniform(70, 98)]) for _ in range(length)]
+    else:
+        raise ValueError(f"Unknown pLDDT profile {kind}.")
+
+    # Exact ties with the default threshold exercise the edge cases in trimming.
+    return [70.0 if rng.random() < 0.02 else round(v, 2) for v in values]
+
+
+def iter_atoms(seq, rng):
+    serial = 1
+    for i, aa in enumerate(seq):
+        for name, element in BACKBONE_ATOMS:
+            if aa == "G" and name == "CB":
+                continue
+
+            x, y, z = (rng.uniform(-50, 50) for _ in range(3))
+            yield serial, i, aa, name, element, x, y, z
+            serial += 1
+    return
+
+
+def wrap_semicolon_field(seq, width=80):
+    lines = [seq[i:i + width] for i in range(0, len(seq), width)]
+    lines[0] = ";" + lines[0]
+    lines.append(";")
+    return lines
+
+
+def make_mmcif(name, seq, plddt, rng):
+    """ An mmCIF string laid out like the AlphaFold DB files. """
+    lines = [
+        f"data_{name}",
+        "#",
+        f"_entry.id {name}",
+        "#",
+        "loop_",
+        "_atom_type.symbol",
+        "C",
+        "N",
+        "O",
+        "S",
+        "#",
+        "loop_",
+    ]
+    lines.extend(f"_atom_site.{c}" for c in ATOM_SITE_COLUMNS)
+
+    for serial, i, aa, atom, element, x, y, z in iter_atoms(seq, rng):
+        resname = THREE_LETTER[aa]
+        lines.append(
+            f"ATOM {serial} {element} {atom} . {resname} A 1 {i + 1} ? "
+            f"{x:.3f} {y:.3f} {z:.3f} 1.0 {plddt[i]:.2f} 0 {i + 1} {resname} A {atom} 1"
+        )
+
+    lines.append("#")
+    lines.extend([
+        "_entity_poly.entity_id 1",
+        "_entity_poly.nstd_linkage no",
+        "_entity_poly.nstd_monomer no",
+        "_entity_poly.pdbx_seq_one_letter_code",
+        *wrap_semicolon_field(seq),
+        "_entity_poly.pdbx_seq_one_letter_code_can",
+        *wrap_semicolon_field(seq),
+        "_entity_poly.pdbx_strand_id A",
+        "_entity_poly.type polypeptide(L)",
+        "#",
+        "loop_",
+        "_ma_qa_metric_local.label_asym_id",
+        "_ma_qa_metric_local.label_comp_id",
+        "_ma_qa_metric_local.label_seq_id",
+        "_ma_qa_metric_local.metric_id",
+        "_ma_qa_metric_local.metric_value",
+        "_ma_qa_metric_local.model_id",
+        "_ma_qa_metric_local.ordinal_id",
+    ])
+
+    for i, aa in enumerate(seq):
+        lines.append(f"A {THREE_LETTER[aa]} {i + 1} 2 {plddt[i]:.2f} 1 {i + 1}")
+
+    lines.append("#")
+    return "\n".join(lines) + "\n"
+
+
+def make_pdb(name, seq, plddt, rng):
+    """ A PDB string laid out like the AlphaFold DB files (pLDDT in the B-factor). """
+    lines = [f"HEADER    {name:<70}"]
+
+    resnames = [THREE_LETTER[aa] for aa in seq]
+    for i in range(0, len(resnames), 13):
+        chunk = " ".join(resnames[i:i + 13])
+        lines.append(f"SEQRES {i // 13 + 1:>3} A {len(seq):>4}  {chunk:<51}")
+
+    for serial, i, aa, atom, element, x, y, z in iter_atoms(seq, rng):
+        lines.append(
+            f"ATOM  {serial:>5}  {atom:<3} {THREE_LETTER[aa]} A{i + 1:>4}    "
+            f"{x:8.3f}{y:8.3f}{z:8.3f}{1.0:6.2f}{plddt[i]:6.2f}          {element:>2}  "
+        )
+
+    lines.append(f"TER   {serial + 1:>5}      {THREE_LETTER[seq[-1]]} A{len(seq):>4}")
+    lines.append("END")
+    return "\n".join(lines) + "\n"
+
+
+def write_structures(
+    outdir,
+    n,
+    min_length=50,
+    max_length=600,
+    profile="ends",
+    formats=("cif",),
+    compress=False,
+    seed=1
+):
+    """ Write n structures in each format, returning the filenames. """
+    rng = random.Random(seed)
+    os.makedirs(outdir, exist_ok=True)
+
+    filenames = []
+    for i in range(n):
+        name = f"AF-S{i:07d}-F1-model_v4"
+        length = rng.randint(min_length, max_length)
+        seq = random_protein(length, rng)
+        plddt = plddt_profile(length, rng, profile)
+
+        for format_ in formats:
+            if format_ == "cif":
+                text = make_mmcif(name, seq, plddt, rng)
+            elif format_ == "pdb":
+                text = make_pdb(name, seq, plddt, rng)
+            else:
+                raise ValueError(f"Unknown format {format_}.")
+
+            filename = pjoin(outdir, f"{name}.{format_}")
+            if compress:
+                filename += ".gz"
+                with gzip.open(filename, "wt") as handle:
+                    handle.write(text)
+            else:
+                with open(filename, "w") as handle:
+                    handle.write(text)
+
+            filenames.append(filename)
+
+    return filenames
+
+
+FAKE_TARGETP = r'''#!/usr/bin/env python3
+# A stand in for TargetP 2 that gives deterministic predictions
+# in the same output format, without needing the models.
+
+import sys
+from hashlib import md5
+
+args = sys.argv[1:]
+fasta = args[args.index("-fasta") + 1]
+plant = args[args.index("-org") + 1] == "pl"
+
+print("# TargetP-2.0\tOrganism: " + ("Plant" if plant else "Non-Plant") + "\tTimestamp: 0")
+if plant:
+    print("# ID\tPrediction\tnoTP\tSP\tmTP\tcTP\tluTP\tCS Position")
+else:
+    print("# ID\tPrediction\tnoTP\tSP\tmTP\tCS Position")
+
+ids = []
+seqs = dict()
+current = None
+with open(fasta) as handle:
+    for line in handle:
+        line = line.strip()
+        if line.startswith(">"):
+            current = line[1:].split()[0]
+            ids.append(current)
+            seqs[current] = []
+        elif current is not None:
+            seqs[current].append(line)
+
+for id_ in ids:
+    h = int(md5("".join(seqs[id_]).encode()).hexdigest(), 16)
+    if h % 3 == 0:
+        cs = 15 + h % 20
+        extra = "\t0.000\t0.000" if plant else ""
+        print(f"{id_}\tSP\t0.001\t0.998\t0.001{extra}\tCS pos: {cs}-{cs + 1}. AAA-AA. Pr: 0.7")
+    else:
+        extra = "\t0.000\t0.000" if plant else ""
+        print(f"{id_}\tnoTP\t0.990\t0.005\t0.005{extra}\t")
+'''
+
+
+def write_fake_targetp(filename):
+    with open(filename, "w") as handle:
+        handle.write(FAKE_TARGETP)
+
+    os.chmod(filename, 0o755)
+    return filename
+
+
+def random_dna(length, rng):
+    return "".join(rng.choice("ACGT") for _ in range(length))
+
+
+def write_variants(
+    outdir,
+    ncontigs=5,
+    contig_length=200000,
+    nbreaks=20,
+    seed=1
+):
+    """ Write a fasta and a sniffles2 style VCF of BND variants between its contigs.
+
+    Returns the fasta and VCF filenames.
+    """
+    rng = random.Random(seed)
+    os.makedirs(outdir, exist_ok=True)
+
+    contigs = [(f"contig{i + 1}", random_dna(contig_length, rng)) for i in range(ncontigs)]
+
+    fasta = pjoin(outdir, "genome.fasta")
+    with open(fasta, "w") as handle:
+        for name, seq in contigs:
+            handle.write(f">{name}\n")
+            for i in range(0, len(seq), 60):
+                handle.write(seq[i:i + 60] + "\n")
+
+    records = []
+    for i in range(nbreaks):
+        chrom, _ = rng.choice(contigs)
+        mate, _ = rng.choice(contigs)
+        pos = rng.randint(1, contig_length)
+        mate_pos = rng.randint(1, contig_length)
+        genotype = rng.choice(["0/1", "1/1", "1/1"])
+        dr = rng.randint(0, 10)
+        dv = rng.randint(2, 30)
+        records.append((chrom, pos, (
+            f"{chrom}\t{pos}\tSniffles2.BND.{i}\tN\tN[{mate}:{mate_pos}[\t60\tPASS\t"
+            f"PRECISE;SVTYPE=BND;SUPPORT={dv};COVERAGE={dr + dv}\tGT:GQ:DR:DV\t"
+            f"{genotype}:60:{dr}:{dv}"
+        )))
+
+    vcf = pjoin(outdir, "variants.vcf")
+    with open(vcf, "w") as handle:
+        handle.write("##fileformat=VCFv4.2\n")
+        handle.write("##source=Sniffles2\n")
+        for name, seq in contigs:
+            handle.write(f"##contig=<ID={name},length={len(seq)}>\n")
+        handle.write('##ALT=<ID=BND,Description="Breakend; Translocation">\n')
+        handle.write('##INFO=<ID=PRECISE,Number=0,Type=Flag,Description="Precise structural variant">\n')
+        handle.write('##INFO=<ID=SVTYPE,Number=1,Type=String,Description="Type of structural variation">\n')
+        handle.write('##INFO=<ID=SUPPORT,Number=1,Type=Integer,Description="Number of reads supporting the variant">\n')
+        handle.write('##INFO=<ID=COVERAGE,Number=1,Type=Integer,Description="Coverage at the variant">\n')
+        handle.write('##FORMAT=<ID=GT,Number=1,Type=String,Description="Genotype">\n')
+        handle.write('##FORMAT=<ID=GQ,Number=1,Type=Integer,Description="Genotype quality">\n')
+        handle.write('##FORMAT=<ID=DR,Number=1,Type=Integer,Description="Number of reference reads">\n')
+        handle.write('##FORMAT=<ID=DV,Number=1,Type=Integer,Description="Number of variant reads">\n')
+        handle.write("#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tSAMPLE\n")
+
+        order = {name: i for i, (name, _) in enumerate(contigs)}
+        for _, _, line in sorted(records, key=lambda r: (order[r[0]], r[1])):
+            handle.write(line + "\n")
+
+    return fasta, vcf
+
+
+def cli():
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        prog="generate.py",
+        description="Generate synthetic data for benchmarking."
+    )
+
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    structures = subparsers.add_parser("structures", help="AlphaFold style structure files.")
+    structures.add_argument("outdir", type=str, help="Where to write the files.")
+    structures.add_argument("-n", "--number", type=int, default=100, help="How many structures. Default: 100")
+    structures.add_argument("--min-length", type=int, default=50, help="Default: 50")
+    structures.add_argument("--max-length", type=int, default=600, help="Default: 600")
+    structures.add_argument(
+        "--profile",
+        default="ends",
+        choices=PLDDT_PROFILES,
+        help="The shape of the pLDDT values along the sequence. Default: ends"
+    )
+    structures.add_argument(
+        "--formats",
+        nargs="+",
+        default=["cif"],
+        choices=["cif", "pdb"],
+        help="Default: cif"
+    )
+    structures.add_argument("-g", "--compress", default=False, action="store_true", help="Gzip the files.")
+    structures.add_argument("--seed", type=int, default=1, help="Default: 1")
+
+    targetp = subparsers.add_parser("targetp", help="A fake targetp executable.")
+    targetp.add_argument("outfile", type=str, help="Where to write the executable.")
+
+    variants = subparsers.add_parser("variants", help="A fasta and sniffles2 style BND VCF.")
+    variants.add_argument("outdir", type=str, help="Where to write the files.")
+    variants.add_argument("--contigs", type=int, default=5, help="Default: 5")
+    variants.add_argument("--contig-length", type=int, default=200000, help="Default: 200000")
+    variants.add_argument("--breaks", type=int, default=20, help="Default: 20")
+    variants.add_argument("--seed", type=int, default=1, help="Default: 1")
+
+    return parser.parse_args()
+
+
+def main():
+    args = cli()
+
+    if args.command == "structures":
+        filenames = write_structures(
+            args.outdir,
+            args.number,
+            min_length=args.min_length,
+            max_length=args.max_length,
+            profile=args.profile,
+            formats=args.formats,
+            compress=args.compress,
+            seed=args.seed
+        )
+        print("\n".join(filenames))
+    elif args.command == "targetp":
+        print(write_fake_targetp(args.outfile))
+    elif args.command == "variants":
+        print("\n".join(write_variants(
+            args.outdir,
+            ncontigs=args.contigs,
+            contig_length=args.contig_length,
+            nbreaks=args.breaks,
+            seed=args.seed
+        )))
+    return
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,490 @@
+#!/usr/bin/env python3
+
+""" Time the main stages of the python scripts in bin/ on synthetic data.
+
+Each stage is run a few times and the best time is reported as a throughput
+(e.g. residues or files per second).
+The speedups of the fast code paths over the simple ones (e.g.
+trim_lddt_batch over trim_lddt_python) are compared against a stored
+baseline to catch regressions. Throughputs are machine dependent, so they
+are only checked against the baseline if asked to, and the baseline should
+be updated when running somewhere new.
+"""
+
+import io
+import sys
+import json
+import time
+import shutil
+import tempfile
+import warnings
+import importlib.util
+from contextlib import redirect_stdout
+from os.path import dirname, realpath
+from os.path import join as pjoin
+
+BENCH_DIR = dirname(realpath(__file__))
+BIN_DIR = pjoin(dirname(BENCH_DIR), "bin")
+LIB_DIR = pjoin(dirname(BENCH_DIR), "lib")
+DEFAULT_BASELINE = pjoin(BENCH_DIR, "baseline.json")
+
+# Pairs of (fast, simple) stages that do the same work. The ratio of their
+# throughputs doesn't depend much on the machine, so it can be compared
+# against a baseline from somewhere else.
+SPEEDUPS = [
+    ("trim_lddt_batch", "trim_lddt_python"),
+]
+
+sys.path.insert(0, BENCH_DIR)
+sys.path.insert(0, LIB_DIR)
+import generate
+from fasta_io import iter_fasta
+
+
+def load_script(name):
+    """ Import one of the scripts in bin/ as a module. """
+    spec = importlib.util.spec_from_file_location(
+        name.replace(".py", ""),
+        pjoin(BIN_DIR, name)
+    )
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def best_of(fn, repeats):
+    """ Run fn repeats times, returning the shortest time and the last result. """
+    best = float("inf")
+    result = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def read_breaks(vcf):
+    """ Both ends of every BND in the VCF, without needing pysam. """
+    import re
+    from collections import defaultdict
+
+    regex = re.compile(r"[A-Z]+[\[\]](?P<chrom>[^:]+):(?P<pos>\d+)[\[\]]")
+
+    breaks = defaultdict(list)
+    with open(vcf) as handle:
+        for line in handle:
+            if line.startswith("#"):
+                continue
+
+            chrom, pos, _, _, alt = line.split("\t", 5)[:5]
+            breaks[chrom].append(int(pos))
+
+            match = regex.match(alt)
+            breaks[match["chrom"]].append(int(match["pos"]))
+    return breaks
+
+
+def bench_trim(workdir, args, stages):
+    trim = load_script("trim_alphafold_cifs.py")
+
+    cifs = generate.write_structures(
+        pjoin(workdir, "cifs"),
+        args.number,
+        formats=("cif",),
+        compress=args.compress,
+        seed=args.seed
+    )
+    targetp = generate.write_fake_targetp(pjoin(workdir, "targetp"))
+
+    seconds, structure_data = best_of(
+        lambda: [trim.MMCIFData.read(f) for f in cifs],
+        args.repeats
+    )
+    nresidues = sum(len(s.lddt) for s in structure_data)
+    stages["parse"] = (seconds, len(cifs), "files")
+
+    # Trimming is quick, so repeat the inputs to get a measurable time.
+    lddts = [s.lddt for s in structure_data] * 50
+    nresidues *= 50
+
+    def python_trims():
+        return (
+            [trim.trim_lddt_left(l) for l in lddts],
+            [trim.trim_lddt_right(l) for l in lddts],
+        )
+
+    seconds, (lefts, rights) = best_of(python_trims, args.repeats)
+    stages["trim_lddt_python"] = (seconds, nresidues, "residues")
+
+    seconds, (blefts, brights) = best_of(
+        lambda: trim.trim_lddt_batch(lddts),
+        args.repeats
+    )
+    stages["trim_lddt_batch"] = (seconds, nresidues, "residues")
+
+    # Catch any optimisations that change the answers.
+    assert list(blefts) == lefts, "trim_lddt_batch disagrees with trim_lddt_left."
+    assert list(brights) == rights, "trim_lddt_batch disagrees with trim_lddt_right."
+
+    seqs = [(s.id, s.seq) for s in structure_data]
+    seconds, predictions = best_of(
+        lambda: trim.run_targetp(seqs, cmd=targetp),
+        args.repeats
+    )
+    stages["run_targetp"] = (seconds, len(seqs), "sequences")
+    assert len(predictions) == len(seqs), "TargetP didn't give a prediction for every sequence."
+
+    trimmed = trim.StructureChunk.from_records([
+        s._replace(left_trim=int(left), right_trim=int(right))
+        for s, left, right
+        in zip(structure_data, blefts[:len(cifs)], brights[:len(cifs)])
+        if left <= right
+    ])
+
+    def write():
+        outdir = pjoin(workdir, "trimmed")
+        shutil.rmtree(outdir, ignore_errors=True)
+        return trim.trim_em(outdir, trimmed, {}, minsize=10)
+
+    seconds, _ = best_of(write, args.repeats)
+    stages["write"] = (seconds, len(trimmed), "files")
+
+    def process():
+        outdir = pjoin(workdir, "processed")
+        shutil.rmtree(outdir, ignore_errors=True)
+        with redirect_stdout(io.StringIO()):
+            trim.process_batch(cifs, outdir, 70, 5, False, targetp, minsize=10)
+
+    seconds, _ = best_of(process, args.repeats)
+    stages["process_batch"] = (seconds, len(cifs), "files")
+    return
+
+
+def bench_extract(workdir, args, stages):
+    extract = load_script("extract_structure_seq.py")
+
+    filenames = generate.write_structures(
+        pjoin(workdir, "extract"),
+        args.number,
+        formats=("cif", "pdb"),
+        compress=args.compress,
+        seed=args.seed
+    )
+    cifs = [f for f in filenames if ".cif" in f]
+    pdbs = [f for f in filenames if ".pdb" in f]
+
+    seconds, cif_seqs = best_of(
+        lambda: [extract.get_seq_from_mmcif(f) for f in cifs],
+        args.repeats
+    )
+    stages["get_seq_from_mmcif"] = (seconds, len(cifs), "files")
+
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        seconds, pdb_seqs = best_of(
+            lambda: [extract.get_seq_from_pdb(f) for f in pdbs],
+            args.repeats
+        )
+    stages["get_seq_from_pdb"] = (seconds, len(pdbs), "files")
+
+    for (cid, _, cseq), (pid, _, pseq) in zip(cif_seqs, pdb_seqs):
+        assert cseq == pseq, f"The sequences for {cid} and {pid} differ."
+    return
+
+
+def bench_split(workdir, args, stages):
+    split = load_script("split_assembly_at_variants.py")
+
+    fasta, vcf = generate.write_variants(
+        pjoin(workdir, "variants"),
+        ncontigs=args.contigs,
+        nbreaks=args.breaks,
+        seed=args.seed
+    )
+
+    try:
+        import pysam  # noqa: F401
+        seconds, breaks = best_of(lambda: split.find_breaks(vcf, min_dv=0, min_dvdr=0), args.repeats)
+        stages["find_breaks"] = (seconds, args.breaks, "variants")
+    except ImportError:
+        breaks = read_breaks(vcf)
+
+    with open(fasta, "rb") as handle:
+        seqs = list(iter_fasta(handle))
+
+    nbases = sum(len(s) for _, _, s in seqs)
+
+    def split_seqs():
+        out = []
+        for _ in range(50):
+            for seq in seqs:
+                out.extend(split.break_seq(seq, breaks.get(seq[0], [])))
+        return out
+
+    seconds, _ = best_of(split_seqs, args.repeats)
+    stages["break_seq"] = (seconds, nbases * 50, "bases")
+    return
+
+
+def summarise(stages):
+    return {
+        name: {
+            "seconds": seconds,
+            "units": units,
+            "unit": unit,
+            "per_second": units / seconds if seconds > 0 else None,
+        }
+        for name, (seconds, units, unit) in stages.items()
+    }
+
+
+def speedups(results):
+    """ The throughput of each fast stage over its simple counterpart. """
+    out = dict()
+    for fast, simple in SPEEDUPS:
+        if (fast not in results) or (simple not in results):
+            continue
+
+        fast_rate = results[fast]["per_second"]
+        simple_rate = results[simple]["per_second"]
+        if (fast_rate is None) or (simple_rate is None) or (simple_rate == 0):
+            continue
+
+        out[f"{fast}/{simple}"] = fast_rate / simple_rate
+    return out
+
+
+def compare_speedups(observed, baseline, tolerance):
+    """ Find the speedups that fell below the baseline by more than tolerance. """
+    regressions = []
+    for name, speedup in observed.items():
+        if name not in baseline:
+            continue
+
+        expected = baseline[name]
+        if speedup < (expected * (1 - tolerance)):
+            regressions.append((name, expected, speedup))
+    return regressions
+
+
+def compare(results, baseline, tolerance):
+    """ Find the stages that got slower than the baseline by more than tolerance. """
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+
+        expected = baseline[name]["per_second"]
+        observed = result["per_second"]
+        if (expected is None) or (observed is None):
+            continue
+
+        if observed < (expected * (1 - tolerance)):
+            regressions.append((name, expected, observed))
+    return regressions
+
+
+def print_table(results, baseline, handle=sys.stdout):
+    print("stage\tseconds\tunits\tper_second\tbaseline\tratio", file=handle)
+    for name, result in results.items():
+        base = baseline.get(name, {}).get("per_second", None)
+        ratio = "" if base is None else f"{result['per_second'] / base:.2f}"
+        base = "" if base is None else f"{base:.1f}"
+        print(
+            f"{name}\t{result['seconds']:.4f}\t{result['units']} {result['unit']}\t"
+            f"{result['per_second']:.1f}\t{base}\t{ratio}",
+            file=handle
+        )
+    return
+
+
+def print_speedups(observed, baseline, handle=sys.stdout):
+    print("speedup\tobserved\tbaseline", file=handle)
+    for name, speedup in observed.items():
+        base = baseline.get(name, None)
+        base = "" if base is None else f"{base:.2f}"
+        print(f"{name}\t{speedup:.2f}\t{base}", file=handle)
+    return
+
+
+def cli():
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        prog="run_benchmarks.py",
+        description="Benchmark the python scripts in bin/ on synthetic data."
+    )
+
+    parser.add_argument(
+        "-n", "--number",
+        type=int,
+        default=100,
+        help="How many structures to generate. Default: 100"
+    )
+
+    parser.add_argument(
+        "-g", "--compress",
+        default=False,
+        action="store_true",
+        help="Gzip the generated structures."
+    )
+
+    parser.add_argument(
+        "--contigs",
+        type=int,
+        default=5,
+        help="How many contigs to generate for splitting. Default: 5"
+    )
+
+    parser.add_argument(
+        "--breaks",
+        type=int,
+        default=200,
+        help="How many BND variants to generate. Default: 200"
+    )
+
+    parser.add_argument(
+        "-r", "--repeats",
+        type=int,
+        default=3,
+        help="Run each stage this many times and take the best. Default: 3"
+    )
+
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=1,
+        help="Default: 1"
+    )
+
+    parser.add_argument(
+        "--only",
+        nargs="+",
+        choices=["trim", "extract", "split"],
+        default=["trim", "extract", "split"],
+        help="Only run benchmarks for these scripts."
+    )
+
+    parser.add_argument(
+        "-o", "--outfile",
+        type=str,
+        default=None,
+        help="Write the results to this JSON file."
+    )
+
+    parser.add_argument(
+        "-b", "--baseline",
+        type=str,
+        default=DEFAULT_BASELINE,
+        help="The baseline JSON to compare against. Default: bench/baseline.json"
+    )
+
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.25,
+        help=(
+            "Fail if a speedup (or a stage with --check-baseline) is this "
+            "fraction lower than the baseline. Default: 0.25"
+        )
+    )
+
+    parser.add_argument(
+        "--check-baseline",
+        default=False,
+        action="store_true",
+        help=(
+            "Also fail if any stage's throughput is lower than the baseline. "
+            "Only use this with a baseline made on the same machine."
+        )
+    )
+
+    parser.add_argument(
+        "--update-baseline",
+        default=False,
+        action="store_true",
+        help="Overwrite the baseline with these results."
+    )
+
+    parser.add_argument(
+        "--keep",
+        type=str,
+        default=None,
+        help="Generate the data in this directory and keep it, rather than a temporary one."
+    )
+
+    return parser.parse_args()
+
+
+def main():
+    args = cli()
+
+    benchmarks = {
+        "trim": bench_trim,
+        "extract": bench_extract,
+        "split": bench_split,
+    }
+
+    stages = dict()
+    workdir = tempfile.mkdtemp() if args.keep is None else args.keep
+
+    try:
+        for name in args.only:
+            benchmarks[name](workdir, args, stages)
+    finally:
+        if args.keep is None:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    results = summarise(stages)
+
+    try:
+        with open(args.baseline) as handle:
+            baseline = json.load(handle)["stages"]
+    except FileNotFoundError:
+        baseline = dict()
+
+    observed_speedups = speedups(results)
+    baseline_speedups = speedups(baseline)
+
+    print_table(results, baseline)
+    print()
+    print_speedups(observed_speedups, baseline_speedups)
+
+    params = {
+        k: getattr(args, k)
+        for k in ["number", "compress", "contigs", "breaks", "repeats", "seed"]
+    }
+    output = {"params": params, "stages": results, "speedups": observed_speedups}
+
+    if args.outfile is not None:
+        with open(args.outfile, "w") as handle:
+            json.dump(output, handle, indent=2)
+
+    if args.update_baseline:
+        with open(args.baseline, "w") as handle:
+            json.dump(output, handle, indent=2)
+        return
+
+    regressions = compare_speedups(observed_speedups, baseline_speedups, args.tolerance)
+    for name, expected, observed in regressions:
+        print(
+            f"REGRESSION: {name} was {observed:.2f}x, the baseline is {expected:.2f}x.",
+            file=sys.stderr
+        )
+
+    if args.check_baseline:
+        slower = compare(results, baseline, args.tolerance)
+        for name, expected, observed in slower:
+            print(
+                f"REGRESSION: {name} ran at {observed:.1f}/s, the baseline is {expected:.1f}/s.",
+                file=sys.stderr
+            )
+        regressions.extend(slower)
+
+    if len(regressions) > 0:
+        sys.exit(1)
+    return
+
+
+if __name__ == "__main__":
+    main()
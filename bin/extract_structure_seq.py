@@ -3,122 +3,542 @@
 import re
 
 import sys
-import gzip
-from os.path import basename
+from array import array
+from os.path import dirname, realpath
+from os.path import join as pjoin
 
-from Bio.PDB.MMCIF2Dict import MMCIF2Dict
-from Bio.PDB import PDBParser
-
-from Bio.SeqRecord import SeqRecord
-from Bio.Seq import Seq
 from Bio.SeqUtils import seq1
-from Bio import SeqIO
+
+sys.path.insert(0, pjoin(dirname(dirname(realpath(__file__))), "lib"))
+from structure_io import open_text, read_mmcif_dict, iter_input_paths, in_background, path_basename
+from structure_io import split_archive_path, input_size, ARCHIVE_SEP
+from fasta_io import FastaWriter
 
 
 def get_seq_from_mmcif(filename):
-    d = read_mmcif_dict(filename)
+    record, _ = parse_mmcif(filename)
+    return record
+
+
+def parse_mmcif(filename, plddt=False):
+    """ Get the (id, description, sequence) record and pLDDT values from an mmCIF file.
+
+    The pLDDT values are only read if requested, and are None if the
+    file doesn't have any (i.e. it isn't a predicted structure).
+    """
+    # We only need a couple of categories, so we skip tokenising everything else.
+    categories = ["_entity_poly"]
+    if plddt:
+        categories.append("_ma_qa_metric_local")
+
+    d = read_mmcif_dict(filename, categories=categories)
     assert '_entity_poly.pdbx_seq_one_letter_code_can' in d, "Your structure does not contain the Sequence."
 
     # NB this has newlines in it, so we need to substitute it.
     seq_str = re.sub(r"[\s*]+", "", d['_entity_poly.pdbx_seq_one_letter_code_can'][0])
+    record = (path_basename(filename), "", seq_str.encode())
 
-    seq = SeqRecord(
-        id=basename(filename),
-        seq=Seq(seq_str)
-    )
-    return seq
+    if plddt and ('_ma_qa_metric_local.metric_value' in d):
+        values = array("d", map(float, d['_ma_qa_metric_local.metric_value']))
+    else:
+        values = None
+    return record, values
 
 
 def get_seq_from_pdb(filename):
-    s = read_pdb(filename)
-    seq_str = [si.get_resname() for si in s.get_residues()]
-    seq_str = seq1("".join(seq_str))
+    seq_str = seq1("".join(read_pdb_residue_names(filename)))
+    return path_basename(filename), "", seq_str.encode()
+
+
+def read_pdb_residue_names(filename):
+    """ Get the residue names from a PDB file without building the structure.
+
+    If the file has SEQRES records, those are used and we stop reading
+    when the coordinates start.
+    Otherwise the residues are taken from the ATOM and HETATM records the same
+    way that PDBParser builds them, i.e. each distinct
+    (model, chain, hetero flag, residue number, insertion code), grouped by
+    model and chain.
+    """
+    seqres = []
+    chains = dict()
+    model = 0
+    model_open = False
+    last = None
+
+    with open_text(filename) as handle:
+        for line in handle:
+            record = line[:6]
+
+            if record == "SEQRES":
+                seqres.extend(line[19:70].split())
+                continue
+            elif record == "MODEL ":
+                if len(seqres) > 0:
+                    break
+                model += 1
+                model_open = True
+                continue
+            elif record == "ENDMDL":
+                model_open = False
+                continue
+            elif (record != "ATOM  ") and (record != "HETATM"):
+                continue
+
+            # SEQRES always comes before the coordinates.
+            if len(seqres) > 0:
+                break
+
+            # Like PDBParser, atoms outside of a MODEL start a new model.
+            if not model_open:
+                model += 1
+                model_open = True
+
+            # Most atoms are in the same residue as the one before.
+            # Columns 18-27 are the residue name, chain, number and insertion code.
+            this = (model, record, line[17:27])
+            if this == last:
+                continue
+            last = this
+
+            resname = line[17:20].strip()
+            if record == "ATOM  ":
+                hetero_flag = " "
+            elif resname in ("HOH", "WAT"):
+                hetero_flag = "W"
+            else:
+                hetero_flag = f"H_{resname}"
 
-    seq = SeqRecord(
-        id=basename(filename),
-        seq=Seq(seq_str)
-    )
+            key = (hetero_flag, int(line[22:26].split()[0]), line[26])
+            chains.setdefault((model, line[21]), dict()).setdefault(key, resname)
 
-    return seq
+    if len(seqres) > 0:
+        return seqres
 
+    return [
+        resname
+        for residues in chains.values()
+        for resname in residues.values()
+    ]
 
-def test_if_gzipped(filename):
-    with gzip.open(filename) as handle:
-        try:
-            handle.read(1)
-            return True
-        except gzip.BadGzipFile:
-            return False
 
+STRUCTURE_SUFFIXES = {
+    "pdb": (".pdb", ".pdb.gz"),
+    "cif": (".cif", ".cif.gz"),
+    "auto": (".pdb", ".pdb.gz", ".cif", ".cif.gz"),
+}
 
-def read_gzipped_mmcif_dict(filename):
-    from io import StringIO
 
-    # For unknown reasons, the gzipped file seems to be in bytes
-    # even if you specify mode = "r".
-    # Wrapping in a StringIO/TextIO is necessary
-    with gzip.open(filename, mode="rb") as handle:
-        z = StringIO(handle.read().decode())
-        mm = MMCIF2Dict(z)
-    return mm
+def structure_kind(filename, kind="auto"):
+    if kind != "auto":
+        return kind
+    elif filename.endswith("pdb.gz") or filename.endswith("pdb"):
+        return "pdb"
+    elif filename.endswith("cif.gz") or filename.endswith("cif"):
+        return "cif"
+    else:
+        raise ValueError(f"Cannot determine filetype of {filename}")
 
 
-# This is just for consistency with the gzipped variants
-def read_mmcif_dict(filename):
-    if test_if_gzipped(filename):
-        return read_gzipped_mmcif_dict(filename)
-    else:
-        return MMCIF2Dict(filename)
+def get_structure(filename, kind="auto", plddt=False):
+    """ Get the (id, description, sequence) record and the pLDDT values of a structure.
 
+    pLDDT values are only read from mmCIF files, for PDB files they are None.
+    """
+    kind = structure_kind(filename, kind)
 
-def read_pdb(filename):
-    if test_if_gzipped(filename):
-        return read_gzipped_pdb(filename)
+    if kind == "pdb":
+        return get_seq_from_pdb(filename), None
+    elif kind == "cif":
+        return parse_mmcif(filename, plddt=plddt)
     else:
-        parser = PDBParser()
-        return parser.get_structure(basename(filename), filename)
+        raise ValueError("This shouldn't be possible.")
+
+
+class Manifest(object):
+    """ An on-disk SQLite record of the sequences we've already extracted.
+
+    Each structure file is stored with its size and modification time,
+    so that on the next run, files that haven't changed since can be
+    taken from the manifest instead of being parsed again.
+    Entries are keyed by the absolute path, and files that are no longer
+    in the input are just ignored.
+    The pLDDT values are stored too if they were read, files that were
+    added without them are parsed again when they are needed.
+    """
+
+    def __init__(self, filename, buffer_size=1000):
+        import sqlite3
+
+        self.con = sqlite3.connect(filename)
+        self.con.execute(
+            "CREATE TABLE IF NOT EXISTS structures ("
+            "path TEXT NOT NULL PRIMARY KEY, "
+            "size INTEGER NOT NULL, "
+            "mtime_ns INTEGER NOT NULL, "
+            "kind TEXT NOT NULL, "
+            "id TEXT NOT NULL, "
+            "description TEXT NOT NULL, "
+            "seq BLOB NOT NULL, "
+            "has_plddt INTEGER NOT NULL DEFAULT 0, "
+            "plddt BLOB"
+            ") WITHOUT ROWID"
+        )
 
+        # Manifests from before we stored the pLDDT values.
+        columns = {row[1] for row in self.con.execute("PRAGMA table_info(structures)")}
+        if "has_plddt" not in columns:
+            self.con.execute("ALTER TABLE structures ADD COLUMN has_plddt INTEGER NOT NULL DEFAULT 0")
+            self.con.execute("ALTER TABLE structures ADD COLUMN plddt BLOB")
+
+        self.con.commit()
+
+        self.buffer = []
+        self.buffer_size = buffer_size
+        return
+
+    @staticmethod
+    def signature(filename, kind="auto"):
+        """ The key and file details that a manifest entry has to match.
+
+        Members of tar archives ("archive.tar::member") are keyed by the
+        archive path and member name, with the size of the member and
+        the modification time of the archive.
+        """
+        import os
+
+        archive, member = split_archive_path(filename)
+        st = os.stat(archive)
+        path = os.path.abspath(archive)
+
+        if member is None:
+            return path, st.st_size, st.st_mtime_ns, kind
+
+        return f"{path}{ARCHIVE_SEP}{member}", input_size(filename), st.st_mtime_ns, kind
+
+    def get(self, signature, plddt=False):
+        """ The (id, description, sequence) and pLDDT values for an unchanged file.
+
+        Returns None if the file isn't in the manifest, or if the pLDDT values
+        are needed but weren't read when it was added.
+        """
+        path, size, mtime_ns, kind = signature
+        row = self.con.execute(
+            "SELECT id, description, seq, has_plddt, plddt FROM structures "
+            "WHERE path = ? AND size = ? AND mtime_ns = ? AND kind = ?",
+            [path, size, mtime_ns, kind]
+        ).fetchone()
+
+        if row is None:
+            return None
+
+        id_, desc, seq, has_plddt, values = row
+        if plddt and not has_plddt:
+            return None
+
+        if values is not None:
+            values = array("d", values)
+        return (id_, desc, bytes(seq)), values
+
+    def put(self, signature, record, values=None, plddt=False):
+        """ Add a file, plddt says whether we tried to read the pLDDT values. """
+        id_, desc, seq = record
+
+        if values is not None:
+            values = values.tobytes()
+
+        self.buffer.append((*signature, id_, desc, seq, int(plddt), values))
+
+        if len(self.buffer) >= self.buffer_size:
+            self.flush()
+        return
+
+    def flush(self):
+        if len(self.buffer) == 0:
+            return
+
+        with self.con:
+            self.con.executemany(
+                "INSERT OR REPLACE INTO structures "
+                "(path, size, mtime_ns, kind, id, description, seq, has_plddt, plddt) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                self.buffer
+            )
+        self.buffer = []
+        return
+
+    def close(self):
+        self.flush()
+        self.con.close()
+        return
+
+
+def iter_structures(structure_filenames, kind="auto", executor=None, inflight=None, manifest=None, plddt=False):
+    """ Yield (filename, (id, description, sequence), plddt) tuples in the same order as the filenames.
+
+    If executor is given, the files are parsed in its workers, with at most
+    `inflight` files submitted but not yet written at any time.
+    This keeps memory use flat however many filenames there are.
+
+    If a Manifest is given, files that haven't changed since they were
+    added to it aren't parsed, and the new ones are added.
+    The pLDDT values are only read if plddt is True, otherwise they are None.
+    """
+    from collections import deque
+    from concurrent.futures import Future
+
+    # Returns the signature to add to the manifest (if any) and the future.
+    def submit(filename):
+        if manifest is None:
+            signature = None
+        else:
+            # Stat before parsing, so a file that changes while we're
+            # reading it is parsed again next time.
+            signature = Manifest.signature(filename, kind)
+            cached = manifest.get(signature, plddt=plddt)
+
+            if cached is not None:
+                future = Future()
+                future.set_result(cached)
+                return None, future
+
+        if executor is None:
+            future = Future()
+            future.set_result(get_structure(filename, kind, plddt))
+        else:
+            future = executor.submit(get_structure, filename, kind, plddt)
+        return signature, future
+
+    def result(filename, new, future):
+        record, values = future.result()
+        if new is not None:
+            manifest.put(new, record, values, plddt=plddt)
+        return filename, record, values
+
+    if executor is None:
+        for filename in structure_filenames:
+            yield result(filename, *submit(filename))
+        return
+
+    if inflight is None:
+        inflight = 4 * executor._max_workers
+
+    pending = deque()
+    try:
+        for filename in structure_filenames:
+            pending.append((filename, *submit(filename)))
+
+            if len(pending) >= inflight:
+                yield result(*pending.popleft())
+
+        while len(pending) > 0:
+            yield result(*pending.popleft())
+    finally:
+        # If something went wrong, don't bother parsing the rest.
+        for _, _, future in pending:
+            future.cancel()
+    return
 
-def read_gzipped_pdb(filename):
-    from io import StringIO
 
-    # For unknown reasons, the gzipped file seems to be in bytes
-    # even if you specify mode = "r".
-    # Wrapping in a StringIO/TextIO is necessary
-    with gzip.open(filename, mode="rb") as handle:
-        z = StringIO(handle.read().decode())
-        parser = PDBParser()
-        mm = parser.get_structure(basename(filename), z)
-    return mm
+def hash_seq(seq: bytes) -> bytes:
+    from hashlib import blake2b
+    return blake2b(seq, digest_size=DigestSet.DIGEST_SIZE).digest()
+
+
+class DigestSet(object):
+    """ A set of fixed width (16 byte) digests.
+
+    The digests are stored in a flat numpy open addressing table rather than
+    a python set. Each slot is 16 bytes, and the table is kept at most half
+    full, so each digest takes 32 to 64 bytes instead of the 100 or so
+    for a bytes object in a python set.
+    While the table is growing, the old table, the new (twice as big) table
+    and a copy of the digests are all held at once, so the peak is about
+    1.75 times the size of the new table.
+    """
+
+    DIGEST_SIZE = 16
+
+    def __init__(self, capacity=1 << 16):
+        import numpy as np
+
+        # Keep the capacity a power of 2 so we can mask instead of mod.
+        capacity = 1 << max(capacity - 1, 1).bit_length()
+
+        # Each row is a digest as two 64 bit integers, all zeros is an empty slot.
+        self.table = np.zeros((capacity, 2), dtype=np.uint64)
+        self.mask = capacity - 1
+        self.size = 0
+        return
+
+    def __len__(self):
+        return self.size
+
+    @classmethod
+    def _key(cls, digest):
+        hi = int.from_bytes(digest[:8], "little")
+        lo = int.from_bytes(digest[8:], "little")
+
+        # All zeros marks an empty slot. The odds of a real digest being
+        # zero are negligible, but it still has to go somewhere.
+        if (hi == 0) and (lo == 0):
+            lo = 1
+        return hi, lo
+
+    def add(self, digest) -> bool:
+        """ Add a digest, returning True if it wasn't already in the set. """
+        # Keep the table at most half full so that probes stay short.
+        if (2 * (self.size + 1)) > len(self.table):
+            self._grow()
+
+        hi, lo = self._key(digest)
+        table = self.table
+        mask = self.mask
+
+        i = lo & mask
+        while True:
+            h = int(table[i, 0])
+            l = int(table[i, 1])
+
+            if (h == 0) and (l == 0):
+                table[i, 0] = hi
+                table[i, 1] = lo
+                self.size += 1
+                return True
+            elif (h == hi) and (l == lo):
+                return False
+
+            i = (i + 1) & mask
+
+    def __contains__(self, digest) -> bool:
+        hi, lo = self._key(digest)
+        table = self.table
+        mask = self.mask
+
+        i = lo & mask
+        while True:
+            h = int(table[i, 0])
+            l = int(table[i, 1])
+
+            if (h == 0) and (l == 0):
+                return False
+            elif (h == hi) and (l == lo):
+                return True
+
+            i = (i + 1) & mask
+
+    def _grow(self):
+        """ Double the table size, re-inserting the digests in bulk. """
+        import numpy as np
+
+        old = self.table
+        keys = old[(old[:, 0] != 0) | (old[:, 1] != 0)]
+
+        self.table = np.zeros((2 * len(old), 2), dtype=np.uint64)
+        self.mask = len(self.table) - 1
+
+        # Linear probing in rounds. Each round, every key that still needs a
+        # slot looks at its current position. Where that slot is empty, one of
+        # the keys that wants it takes it, and the rest move along one.
+        positions = keys[:, 1] & np.uint64(self.mask)
+        while len(keys) > 0:
+            empty = (self.table[positions, 0] == 0) & (self.table[positions, 1] == 0)
+            candidates = np.flatnonzero(empty)
+            _, first = np.unique(positions[candidates], return_index=True)
+            chosen = candidates[first]
+
+            self.table[positions[chosen]] = keys[chosen]
+
+            left = np.ones(len(keys), dtype=bool)
+            left[chosen] = False
+            keys = keys[left]
+            positions = (positions[left] + np.uint64(1)) & np.uint64(self.mask)
+        return
+
+
+def format_plddt_fastq(id_, seq, values) -> bytes:
+    """ Format the pLDDT values of a structure as a fastq record.
+
+    pLDDT goes from 0 to 100, but fastq qualities only go up to 93,
+    so the values are scaled to fit. They can be recovered (to within
+    about 0.5) with (ord(c) - 33) / 0.93.
+    """
+    import numpy as np
+
+    if len(values) != len(seq):
+        raise ValueError(
+            f"The structure {id_} has {len(values)} pLDDT values "
+            f"but the sequence is {len(seq)} residues long."
+        )
+
+    scaled = np.rint(np.asarray(values) * 0.93).clip(0, 93).astype(np.uint8)
+    quality = (scaled + 33).tobytes()
+    return b"@" + id_.encode() + b"\n" + seq + b"\n+\n" + quality + b"\n"
+
+
+def format_summary_row(id_, seq, values, filename) -> str:
+    if values is None or len(values) == 0:
+        mean = ""
+    else:
+        mean = f"{sum(values) / len(values):.2f}"
+    return f"{id_}\t{len(seq)}\t{mean}\t{filename}\n"
 
 
 def process_batch(
     structure_filenames,
     outfile,
-    kind="auto"
+    kind="auto",
+    executor=None,
+    dedup_index=None,
+    manifest=None,
+    plddt=None,
+    summary=None
 ):
-    for filename in structure_filenames:
-        filename = filename.strip()
-
-        if kind == "auto":
-            if filename.endswith("pdb.gz") or filename.endswith("pdb"):
-                this_kind = "pdb"
-            elif filename.endswith("cif.gz") or filename.endswith("cif"):
-                this_kind = "cif"
-            else:
-                raise ValueError(f"Cannot determine filetype of {filename}")
-        else:
-            this_kind = kind
+    """ Write the sequences of the structures to outfile.
+
+    If dedup_index is a text handle, each distinct sequence is only written
+    once, with the hex of its hash as the id. The hash and path of every
+    structure are written to dedup_index as a TSV.
+
+    If manifest is given, only new or changed files are parsed and the rest
+    of the sequences come from the manifest.
+
+    If plddt is a binary handle, the pLDDT values of each structure are
+    written to it as fastq qualities. If summary is a text handle, the id,
+    length, mean pLDDT, and path of each structure are written to it as a TSV.
+    Both of these come from the same parse as the sequences.
+    """
+    structure_filenames = (f.strip() for f in structure_filenames)
+    read_plddt = (plddt is not None) or (summary is not None)
+
+    if dedup_index is not None:
+        seen = DigestSet()
+
+    structures = iter_structures(
+        structure_filenames,
+        kind,
+        executor,
+        manifest=manifest,
+        plddt=read_plddt
+    )
 
+    with FastaWriter(outfile) as writer:
+        for filename, (id_, desc, seq), values in structures:
+            if (plddt is not None) and (values is not None):
+                plddt.write(format_plddt_fastq(id_, seq, values))
 
-        if this_kind == "pdb":
-            seq = get_seq_from_pdb(filename)
-        elif this_kind == "cif":
-            seq = get_seq_from_mmcif(filename)
-        else:
-            raise ValueError("This shouldn't be possible.")
+            if summary is not None:
+                summary.write(format_summary_row(id_, seq, values, filename))
+
+            if dedup_index is None:
+                writer.write(id_, seq, desc)
+                continue
 
-        SeqIO.write([seq], outfile, "fasta")
+            digest = hash_seq(seq)
+            dedup_index.write(f"{digest.hex()}\t{filename}\n")
+
+            if seen.add(digest):
+                writer.write(digest.hex(), seq, id_)
 
     return
 
@@ -133,11 +553,15 @@ def cli():
 
     parser.add_argument(
         "infiles",
-        type=argparse.FileType('r'),
+        type=str,
+        nargs="+",
         help=(
-            "A new-line delimited file containing CIF file paths to process. "
+            "Structure files, directories, or glob patterns (e.g. 'structures/**/*.cif.gz'). "
+            "Directories are searched recursively for files ending with "
+            ".pdb, .pdb.gz, .cif, or .cif.gz (or just those for --kind). "
+            "Any other file is read as a new-line delimited list of file paths to process. "
             "These can be gzipped. "
-            "Use '-' to take from stdin."
+            "Use '-' to take the list from stdin."
         )
     )
 
@@ -154,12 +578,126 @@ def cli():
         choices=["pdb", "cif", "auto"],
         help="What kind of structure files should we expect? Default will try to figure it out by filename extension.",
     )
+
+    parser.add_argument(
+        "--dedup",
+        type=str,
+        default=None,
+        help=(
+            "Only write each distinct sequence once, and write a TSV index to this file "
+            "mapping the sequence hashes to the structure files they came from. "
+            "The fasta ids are the sequence hashes, and the description is the id "
+            "(i.e. the file name) of the first structure it was seen in."
+        )
+    )
+
+    parser.add_argument(
+        "--manifest",
+        type=str,
+        default=None,
+        help=(
+            "An SQLite file recording the sequences extracted from each structure file. "
+            "On later runs, files with the same size and modification time "
+            "are taken from it instead of being parsed again. "
+            "It is created if it doesn't exist."
+        )
+    )
+
+    parser.add_argument(
+        "--plddt",
+        type=str,
+        default=None,
+        help=(
+            "Also write the per-residue pLDDT values of each structure to this file as a fastq. "
+            "The qualities are the pLDDT values scaled to fit in the fastq range, "
+            "i.e. pLDDT = (ord(quality) - 33) / 0.93. "
+            "pLDDT values are only read from mmCIF files (from _ma_qa_metric_local), "
+            "structures without them are left out."
+        )
+    )
+
+    parser.add_argument(
+        "--summary",
+        type=str,
+        default=None,
+        help=(
+            "Also write a TSV with the id, length, mean pLDDT, "
+            "and path of each structure to this file."
+        )
+    )
+
+    parser.add_argument(
+        "-p", "--threads",
+        type=int,
+        default=1,
+        help=(
+            "How many processes to use to parse the structures. "
+            "The sequences are still written in the same order as the input. "
+            "Default: 1"
+        )
+    )
     return parser.parse_args()
 
 
 def main():
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+
     args = cli()
-    process_batch(args.infiles, args.outfile, args.kind)
+
+    if args.threads > 1:
+        # The files are listed in a background thread, so don't fork the workers.
+        executor = ProcessPoolExecutor(
+            max_workers=args.threads,
+            mp_context=multiprocessing.get_context("forkserver")
+        )
+    else:
+        executor = None
+
+    if args.dedup is not None:
+        dedup_index = open(args.dedup, "w")
+        dedup_index.write("hash\tfilename\n")
+    else:
+        dedup_index = None
+
+    if args.manifest is not None:
+        manifest = Manifest(args.manifest)
+    else:
+        manifest = None
+
+    if args.plddt is not None:
+        plddt = open(args.plddt, "wb")
+    else:
+        plddt = None
+
+    if args.summary is not None:
+        summary = open(args.summary, "w")
+        summary.write("id\tlength\tmean_plddt\tpath\n")
+    else:
+        summary = None
+
+    try:
+        process_batch(
+            in_background(iter_input_paths(args.infiles, suffixes=STRUCTURE_SUFFIXES[args.kind])),
+            args.outfile,
+            args.kind,
+            executor,
+            dedup_index,
+            manifest,
+            plddt,
+            summary
+        )
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+
+        for handle in (dedup_index, plddt, summary):
+            if handle is not None:
+                handle.close()
+
+        # Save what we did manage to parse, even if something failed.
+        if manifest is not None:
+            manifest.close()
     return
 
 
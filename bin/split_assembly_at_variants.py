@@ -105,6 +105,13 @@ def find_breaks(vcf, min_dv: int = 4, max_dr: int = 100, min_dvdr = 1.5, hets =
 
 
 def break_seq(seq, breaks, min_length: int = 100):
+    """ Split an (id, description, sequence) record at the break points.
+
+    Returns a list of (id, description, sequence) records, where the description
+    is the start and end of the piece in the original sequence.
+    """
+    id_, _, sequence = seq
+
     i = 0
     n = 1
 
@@ -114,27 +121,25 @@ def break_seq(seq, breaks, min_length: int = 100):
             continue
 
         if (j - i) > min_length:
-            new_seq = seq[i:j]
-            new_seq.id = f"{seq.id}_{n}"
-            new_seq.name = new_seq.id
-            new_seq.description = f"{i} {j}"
-            out.append(new_seq)
+            out.append((f"{id_}_{n}", f"{i} {j}", sequence[i:j]))
             n += 1
         
         i = j
 
-    if i < (len(seq) - min_length):
-        new_seq = seq[i:]
-        new_seq.id = f"{seq.id}_{n}"
-        new_seq.name = new_seq.id
-        new_seq.description = f"{i} {len(seq)}"
-        out.append(new_seq)
+    if i < (len(sequence) - min_length):
+        out.append((f"{id_}_{n}", f"{i} {len(sequence)}", sequence[i:]))
 
     return out
 
 
 def main():
-    from Bio import SeqIO
+    import sys
+    from os.path import dirname, realpath
+    from os.path import join as pjoin
+
+    sys.path.insert(0, pjoin(dirname(dirname(realpath(__file__))), "lib"))
+    from fasta_io import iter_fasta, FastaWriter
+
     args = cli()
 
     breaks = find_breaks(
@@ -145,16 +150,12 @@ def main():
         hets=args.hets
     )
 
-    seqs = SeqIO.parse(args.fasta, "fasta")
-
-    out_seqs = []
-    for seq in seqs:
-        if seq.id in breaks:
-            out_seqs.extend(break_seq(seq, breaks[seq.id], min_length=args.min_contig))
-        else:
-            out_seqs.append(seq)
-
-    SeqIO.write(out_seqs, args.outfile, "fasta")
+    with FastaWriter(args.outfile) as writer:
+        for seq in iter_fasta(args.fasta):
+            if seq[0] in breaks:
+                writer.write_records(break_seq(seq, breaks[seq[0]], min_length=args.min_contig))
+            else:
+                writer.write_records([seq])
 
 
 if __name__ == "__main__":
@@ -2,19 +2,19 @@
 import re
 
 import os
+import sys
 import shutil
-import gzip
 from os import makedirs
-from os.path import basename, splitext, isfile
+from os.path import basename, splitext, isfile, dirname, realpath
 from os.path import join as pjoin
+from array import array
 from typing import NamedTuple
+from contextlib import contextmanager
 
-from Bio.PDB import MMCIFParser
-from Bio.PDB.MMCIF2Dict import MMCIF2Dict
-from Bio.PDB import PDBIO, Select
-
-from Bio.SeqRecord import SeqRecord
-from Bio.Seq import Seq
+sys.path.insert(0, pjoin(dirname(dirname(realpath(__file__))), "lib"))
+from structure_io import open_text, open_output, expand_archives, read_mmcif_dict
+from structure_io import iter_input_paths, in_background, path_basename
+from fasta_io import FastaWriter
 
 
 CS_POS_REGEX = re.compile(
@@ -38,15 +38,6 @@ def try_convert(val, fn, err):
         raise ValueError(err)
 
 
-def test_if_gzipped(filename):
-    with gzip.open(filename) as handle:
-        try:
-            handle.read(1)
-            return True
-        except gzip.BadGzipFile:
-            return False
-
-
 def trim_lddt_left(lddt, threshold=70, window_size=5):
 
     j = 1
@@ -85,21 +76,153 @@ def trim_lddt_right(lddt, threshold=70, window_size=5):
     return current_trim
 
 
+def trim_lddt_batch(lddts, threshold=70, window_size=5):
+    """ Find the left and right trim points for many structures at once.
+
+    This gives the same results as trim_lddt_left and trim_lddt_right
+    (including their edge cases), but uses cumulative sums over a padded
+    array rather than summing every window separately.
+
+    lddts is a sequence of (possibly different length) non-empty sequences
+    of LDDT values. Returns two integer arrays (left trims and right trims).
+    """
+    import numpy as np
+
+    if window_size < 1:
+        raise ValueError("The window size must be at least 1.")
+
+    nrows = len(lddts)
+    lengths = np.fromiter((len(l) for l in lddts), dtype=np.int64, count=nrows)
+
+    if nrows == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+    if lengths.min() < 1:
+        raise ValueError("Cannot trim a structure without any LDDT values.")
+
+    ncols = int(lengths.max())
+    rows = np.arange(nrows)
+    cols = np.arange(ncols)
+    in_row = cols[np.newaxis, :] < lengths[:, np.newaxis]
+
+    values = np.zeros((nrows, ncols), dtype=np.float64)
+    values[in_row] = np.concatenate([np.asarray(l, dtype=np.float64) for l in lddts])
+
+    high = in_row & (values >= threshold)
+
+    # Window sums from the difference of cumulative sums.
+    # Index i is the window lddt[i:i + window_size].
+    nwindows = max(ncols - window_size + 1, 0)
+    csum = np.zeros((nrows, ncols + 1), dtype=np.float64)
+    np.cumsum(values, axis=1, out=csum[:, 1:])
+    window_sums = csum[:, window_size:] - csum[:, :nwindows]
+    passes = (window_sums / window_size) >= threshold
+
+    # The cumsum differences can be off by a few ulps compared to summing
+    # the window directly, which matters if the mean is right on the
+    # threshold. For those few windows we fall back to the original sum.
+    eps = np.finfo(np.float64).eps
+    bound = 4 * (ncols + 1) * eps * np.abs(values).sum(axis=1, keepdims=True)
+    bound += 4 * eps * abs(threshold * window_size)
+    window_starts = cols[np.newaxis, :nwindows]
+    valid = window_starts <= (lengths[:, np.newaxis] - window_size)
+    unsure = valid & (np.abs(window_sums - threshold * window_size) <= bound)
+
+    for r, i in zip(*np.nonzero(unsure)):
+        window = [float(v) for v in lddts[r][i:i + window_size]]
+        passes[r, i] = (sum(window) / window_size) >= threshold
+
+    # Left side. trim_lddt_left only checks windows starting at
+    # 0 .. len - window_size - 1, and defaults to len - 1 (or 1 if there
+    # are no windows to check).
+    left_ok = passes & (window_starts <= (lengths[:, np.newaxis] - window_size - 1))
+    if nwindows > 0:
+        left_any = left_ok.any(axis=1)
+        left_first = left_ok.argmax(axis=1)
+    else:
+        left_any = np.zeros(nrows, dtype=bool)
+        left_first = np.zeros(nrows, dtype=np.int64)
+
+    j = np.where(
+        left_any,
+        left_first + window_size,
+        np.where(lengths - window_size >= 1, lengths - 1, 1)
+    )
+
+    # Walk back over the run of high scoring residues ending at j - 1.
+    # If that run reaches the start, the original loop wraps around
+    # and checks lddt[-1] before stopping.
+    last_low = np.maximum.accumulate(np.where(high, -1, cols[np.newaxis, :]), axis=1)
+    run_start = last_low[rows, j - 1]
+    left_trims = np.where(
+        run_start >= 0,
+        run_start + 1,
+        -high[rows, lengths - 1].astype(np.int64)
+    )
+
+    # Right side. trim_lddt_right checks windows starting at
+    # len - window_size down to 1, and defaults to 1
+    # (or len - 1 if there are no windows to check).
+    right_ok = passes & (window_starts >= 1) & valid
+    if nwindows > 0:
+        right_any = right_ok.any(axis=1)
+        right_last = nwindows - 1 - right_ok[:, ::-1].argmax(axis=1)
+    else:
+        right_any = np.zeros(nrows, dtype=bool)
+        right_last = np.zeros(nrows, dtype=np.int64)
+
+    i = np.where(
+        right_any,
+        right_last,
+        np.where(lengths > window_size, 1, lengths - 1)
+    )
+
+    # Walk forward over the run of high scoring residues starting at i.
+    # Padding is never high, so this stops at the end of each structure.
+    next_low = np.minimum.accumulate(
+        np.where(high, ncols, cols[np.newaxis, :])[:, ::-1],
+        axis=1
+    )[:, ::-1]
+    right_trims = next_low[rows, i]
+
+    return left_trims.astype(np.int64), right_trims.astype(np.int64)
+
+
 class MMCIFData(NamedTuple):
 
     filename: str
     id: str
-    seq: SeqRecord
-    lddt: list[float]
+    seq: str
+    # A packed array of doubles, which is much smaller than a list of floats.
+    lddt: array
     left_trim: int
     right_trim: int
+    # We keep the atom records around (packed with pack_atom_site) so that
+    # we can write the structure later without reading and tokenising the
+    # file a second time.
+    atom_site: dict
 
     @classmethod
-    def from_file(cls, filename, lddt_threshold=70, lddt_window_size=5):
-        d = read_mmcif_dict(filename)
+    def read(cls, filename, atom_site=True, lddt_threshold=None, lddt_window_size=None):
+        """ Parse a structure, finding the LDDT trims if asked to.
+
+        If the LDDT threshold and window size are given, the left_trim and
+        right_trim fields are filled in, and only the atoms of residues that
+        survive the LDDT trimming are kept. Trimming for signal peptides only
+        ever removes more, so that's all we'll need.
+        Otherwise the trims are None, and should be filled in (e.g. with
+        trim_lddt_batch) before passing the record on to trim_em.
+
+        If atom_site is False, only the categories with the sequence and LDDT
+        values are parsed, and the atom_site field is empty.
+        """
+        if atom_site:
+            d = read_mmcif_dict(filename)
+        else:
+            d = read_mmcif_dict(filename, categories=REPORT_CATEGORIES)
 
         assert '_ma_qa_metric_local.metric_value' in d, "Your structure does not contain the LDDT values"
-        lddt = list(map(float, d.get('_ma_qa_metric_local.metric_value', [])))
+        lddt = array("d", map(float, d.get('_ma_qa_metric_local.metric_value', [])))
 
         assert len(lddt) > 0, "This shouldn't happen"
 
@@ -107,33 +230,177 @@ class MMCIFData(NamedTuple):
         assert '_entity_poly.pdbx_seq_one_letter_code_can' in d, "Your structure does not contain the Sequence."
 
         # NB this has newlines in it, so we need to substitute it.
-        seq_str = re.sub(r"[\s*]+", "", d['_entity_poly.pdbx_seq_one_letter_code_can'][0])
+        seq = re.sub(r"[\s*]+", "", d['_entity_poly.pdbx_seq_one_letter_code_can'][0])
         seqid = d['_entry.id'][0]
 
-        seq = SeqRecord(
-            id=seqid,
-            seq=Seq(seq_str)
-        )
-
-        ltrim = trim_lddt_left(lddt, threshold=lddt_threshold, window_size=lddt_window_size)
-        rtrim = trim_lddt_right(lddt, threshold=lddt_threshold, window_size=lddt_window_size)
-
-        if ltrim > rtrim:
-            raise ValueError(
-                f"None of the sequence in {basename(filename)} "
-                "has a high enough LDDT to pass your thresholds."
+        if lddt_threshold is None:
+            left_trim = None
+            right_trim = None
+        else:
+            ltrims, rtrims = trim_lddt_batch(
+                [lddt],
+                threshold=lddt_threshold,
+                window_size=lddt_window_size
             )
+            left_trim = int(ltrims[0])
+            right_trim = int(rtrims[0])
+
+        if not atom_site:
+            atoms = dict()
+        elif lddt_threshold is None:
+            atoms = pack_atom_site(d)
+        else:
+            atoms = pack_atom_site(d, left_trim, right_trim)
 
         return cls(
             filename,
             seqid,
             seq,
             lddt,
-            ltrim,
-            rtrim
+            left_trim,
+            right_trim,
+            atoms
+        )
+
+    @classmethod
+    def from_file(cls, filename, lddt_threshold=70, lddt_window_size=5):
+        mm = cls.read(filename)
+
+        ltrims, rtrims = trim_lddt_batch(
+            [mm.lddt],
+            threshold=lddt_threshold,
+            window_size=lddt_window_size
+        )
+
+        if ltrims[0] > rtrims[0]:
+            raise ValueError(no_lddt_pass_message(filename))
+
+        return mm._replace(left_trim=int(ltrims[0]), right_trim=int(rtrims[0]))
+
+
+class StructureChunk(object):
+    """ The structures in a chunk, stored column-wise.
+
+    Rather than a record per structure, the LDDT values of all structures
+    are packed into a single array with offsets marking where each
+    structure starts, the sequences are stored as bytes, and the trims
+    as integer arrays. This keeps the per-structure overhead down so that
+    much bigger chunks fit in memory.
+
+    atom_sites holds the packed _atom_site records of each structure
+    (see pack_atom_site), which are needed to write the trimmed structures
+    (or are empty dicts if we only read the sequences and LDDT values).
+    """
+
+    def __init__(
+        self,
+        ids,
+        filenames,
+        seqs,
+        lddt,
+        offsets,
+        left_trims,
+        right_trims,
+        atom_sites
+    ):
+        self.ids = ids
+        self.filenames = filenames
+        self.seqs = seqs
+        self.lddt = lddt
+        self.offsets = offsets
+        self.left_trims = left_trims
+        self.right_trims = right_trims
+        self.atom_sites = atom_sites
+        return
+
+    @classmethod
+    def from_records(cls, records):
+        """ Pack a list of MMCIFData records into a chunk. """
+        import numpy as np
+
+        lengths = np.fromiter((len(mm.lddt) for mm in records), dtype=np.int64, count=len(records))
+        offsets = np.zeros(len(records) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+
+        lddt = np.empty(int(offsets[-1]), dtype=np.float64)
+        for mm, start, end in zip(records, offsets[:-1], offsets[1:]):
+            lddt[start:end] = mm.lddt
+
+        def trims(field):
+            return np.array(
+                [-1 if getattr(mm, field) is None else getattr(mm, field) for mm in records],
+                dtype=np.int64
+            )
+
+        return cls(
+            [mm.id for mm in records],
+            [mm.filename for mm in records],
+            [mm.seq.encode() for mm in records],
+            lddt,
+            offsets,
+            trims("left_trim"),
+            trims("right_trim"),
+            [mm.atom_site for mm in records]
+        )
+
+    def __len__(self):
+        return len(self.ids)
+
+    def lengths(self):
+        import numpy as np
+        return np.diff(self.offsets)
+
+    def lddts(self):
+        """ A view of the LDDT values of each structure. """
+        return [
+            self.lddt[start:end]
+            for start, end
+            in zip(self.offsets[:-1], self.offsets[1:])
+        ]
+
+    def iter_seqs(self):
+        """ Yield (id, sequence) pairs. """
+        for id_, seq in zip(self.ids, self.seqs):
+            yield id_, seq.decode()
+        return
+
+    def select(self, indices):
+        """ A new chunk with just the structures at these indices. """
+        import numpy as np
+
+        indices = np.asarray(indices, dtype=np.int64)
+        lengths = self.lengths()[indices]
+
+        offsets = np.zeros(len(indices) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+
+        if len(indices) > 0:
+            lddt = np.concatenate([
+                self.lddt[self.offsets[i]:self.offsets[i + 1]]
+                for i in indices
+            ])
+        else:
+            lddt = np.zeros(0, dtype=np.float64)
+
+        return self.__class__(
+            [self.ids[i] for i in indices],
+            [self.filenames[i] for i in indices],
+            [self.seqs[i] for i in indices],
+            lddt,
+            offsets,
+            self.left_trims[indices],
+            self.right_trims[indices],
+            [self.atom_sites[i] for i in indices]
         )
 
 
+def no_lddt_pass_message(filename):
+    return (
+        f"None of the sequence in {path_basename(filename)} "
+        "has a high enough LDDT to pass your thresholds."
+    )
+
+
 class TargetPPlant(NamedTuple):
 
     id: str
@@ -256,11 +523,61 @@ class TargetP(NamedTuple):
         return
 
 
-def run_targetp(seqs, plant=False, cmd="targetp"):
-    from subprocess import run
-    from tempfile import NamedTemporaryFile
+# TargetP stops getting faster well before it runs out of cores,
+# so big machines are better used running several copies at once.
+TARGETP_MAX_THREADS = 8
+
+# Don't bother splitting batches smaller than this, the model loading
+# time would dominate.
+TARGETP_MIN_BATCH = 100
+
+
+def available_cpus() -> int:
+    """ The number of cores we can use.
+
+    If the OMP_NUM_THREADS environment variable is set, we take that
+    as the total number of cores that TargetP should use.
+    """
+    omp = os.environ.get("OMP_NUM_THREADS", "")
+    if omp.isdigit() and int(omp) > 0:
+        return int(omp)
+
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
 
-    from Bio import SeqIO
+    return os.cpu_count() or 1
+
+
+def plan_targetp_workers(nseqs, workers=None, ncpus=None):
+    """ Decide how to split nseqs sequences between TargetP processes.
+
+    Returns the number of processes, the number of OpenMP threads for each
+    process, and the number of sequences to give each process.
+    If workers is None, it is chosen from the number of cores.
+    """
+    if ncpus is None:
+        ncpus = available_cpus()
+
+    if workers is None:
+        workers = -(-ncpus // TARGETP_MAX_THREADS)
+        workers = min(workers, -(-nseqs // TARGETP_MIN_BATCH))
+
+    workers = max(1, min(workers, nseqs))
+    threads = max(1, ncpus // workers)
+    batch_size = -(-nseqs // workers)
+    return workers, threads, batch_size
+
+
+def run_targetp(seqs, plant=False, cmd="targetp", workers=None, fifo=False):
+    """ Run TargetP on a list of (id, sequence) pairs, returning a dict of id -> prediction.
+
+    The sequences are split between `workers` concurrent TargetP processes,
+    each with its share of the cores set through OMP_NUM_THREADS.
+    By default the number of processes is chosen from the number of cores.
+    If fifo is True, the sequences are given to TargetP through named pipes
+    rather than temporary files.
+    """
+    from concurrent.futures import ThreadPoolExecutor
 
     if (shutil.which(cmd) is None) and (not isfile(cmd)):
         if isfile(pjoin(".", cmd)):
@@ -271,329 +588,2054 @@ def run_targetp(seqs, plant=False, cmd="targetp"):
                 f"or did not exist in {cmd}"
             )
 
-    with NamedTemporaryFile(mode="w") as fp:
-        SeqIO.write(seqs, fp.name, "fasta")
+    seqs = list(seqs)
+    if len(seqs) == 0:
+        return dict()
+
+    workers, threads, batch_size = plan_targetp_workers(len(seqs), workers)
+
+    if workers == 1:
+        # Leave the environment alone so that TargetP behaves as it always has.
+        return run_targetp_process(seqs, plant, cmd, fifo=fifo)
+
+    env = dict(os.environ)
+    env["OMP_NUM_THREADS"] = str(threads)
+
+    batches = [seqs[i:i + batch_size] for i in range(0, len(seqs), batch_size)]
+
+    matches = dict()
+    # The work happens in the subprocesses, so threads are enough here.
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for result in pool.map(
+            lambda batch: run_targetp_process(batch, plant, cmd, env, fifo),
+            batches
+        ):
+            matches.update(result)
+    return matches
+
+
+def run_targetp_process(seqs, plant=False, cmd="targetp", env=None, fifo=False):
+    """ Run a single TargetP process on a list of (id, sequence) pairs.
+
+    The output is parsed line by line as TargetP writes it, rather than
+    holding all of it in memory.
+    If fifo is True, the input fasta is written to a named pipe instead of
+    a temporary file.
+    """
+    from subprocess import Popen, PIPE
+    from tempfile import TemporaryDirectory
+    from collections import deque
+    from threading import Thread
+
+    cls = TargetPPlant if plant else TargetP
+
+    with TemporaryDirectory() as tmpdir:
+        fasta = pjoin(tmpdir, "input.fasta")
+
+        if fifo:
+            os.mkfifo(fasta)
+            feeder = Thread(target=write_fasta_fifo, args=(fasta, seqs), daemon=True)
+            feeder.start()
+        else:
+            with open(fasta, "wb") as handle:
+                write_targetp_fasta(handle, seqs)
+            feeder = None
 
         command = [
             cmd,
             "-org", ("pl" if plant else "non-pl"),
-            "-fasta", fp.name,
+            "-fasta", fasta,
             "-stdout"
         ]
 
-        results = run(command, capture_output=True)
+        # We only keep the ends of the output around for error messages.
+        stderr = deque(maxlen=200)
+        stdout = deque(maxlen=200)
 
-        if results.returncode != 0:
-            raise ValueError(
-                "Something went wrong while running TargetP. \n"
-                f"STDERR: {results.stderr.decode()}"
-                f"STDOUT: {results.stdout.decode()}"
-            )
+        def tee(lines):
+            for line in lines:
+                stdout.append(line)
+                yield line
+            return
+
+        try:
+            with Popen(command, stdout=PIPE, stderr=PIPE, env=env, text=True) as proc:
+                # Read stderr at the same time so that TargetP can't get stuck
+                # waiting for us to empty it.
+                drainer = Thread(target=stderr.extend, args=(proc.stderr,), daemon=True)
+                drainer.start()
+
+                matches = dict()
+                error = None
+                try:
+                    for t in cls.from_iter(tee(proc.stdout)):
+                        matches[t.id] = t
+                except ValueError as e:
+                    # Finish reading so that we can tell if TargetP itself failed.
+                    error = e
+                    stdout.extend(proc.stdout)
+
+                proc.wait()
+                drainer.join()
+        finally:
+            if feeder is not None:
+                unblock_fifo(fasta, feeder)
+
+    if proc.returncode != 0:
+        raise ValueError(
+            "Something went wrong while running TargetP. \n"
+            f"STDERR: {''.join(stderr)}"
+            f"STDOUT: {''.join(stdout)}"
+        )
+    elif error is not None:
+        raise error
 
-        if plant:
-            matches = {t.id: t for t in TargetPPlant.from_iter(results.stdout.decode().split("\n"))}
-        else:
-            matches = {t.id: t for t in TargetP.from_iter(results.stdout.decode().split("\n"))}
     return matches
 
 
-class MMCIFSelect(Select):
+def write_targetp_fasta(handle, seqs):
+    """ Write (id, sequence) pairs as a fasta.
 
-    def __init__(self, start, end):
-        self.start = start
-        self.end = end
-        self.selected = False
-        return
+    TargetP doesn't care about line lengths, so the sequences aren't wrapped.
+    """
+    with FastaWriter(handle, wrap=None) as writer:
+        for id_, seq in seqs:
+            writer.write(id_, seq)
+    return
 
-    def accept_chain(self, chain):
-        # Just in case there are multiple chains, we only take the first.
-        if self.selected:
-            return 0
-        else:
-            self.selected = True
-            return 1
 
-    def accept_residue(self, residue):
+def write_fasta_fifo(fifo, seqs):
+    """ Write the sequences into a named pipe, as TargetP reads them. """
+    # If TargetP exits without reading everything, there's nobody to write to.
+    try:
+        with open(fifo, "wb") as handle:
+            write_targetp_fasta(handle, seqs)
+    except BrokenPipeError:
+        pass
+    return
 
-        _, index, _ = residue.get_id()
-        index -= 1
 
-        if index < self.start:
-            return 0
-        elif index >= self.end:
-            return 0
-        else:
-            return 1
+def unblock_fifo(fifo, feeder):
+    """ Wait for the thread writing to a fifo, unblocking it if needed.
 
+    If TargetP exits without reading all of the fifo (or without opening it),
+    the writer would wait forever. Briefly opening the read end lets it
+    carry on and fail.
+    """
+    while feeder.is_alive():
+        try:
+            fd = os.open(fifo, os.O_RDONLY | os.O_NONBLOCK)
+            os.close(fd)
+        except FileNotFoundError:
+            pass
+        feeder.join(timeout=0.1)
+    return
 
-def read_gzipped_mmcif_dict(filename):
-    from io import StringIO
 
-    # For unknown reasons, the gzipped file seems to be in bytes
-    # even if you specify mode = "r".
-    # Wrapping in a StringIO/TextIO is necessary
-    with gzip.open(filename, mode="rb") as handle:
-        z = StringIO(handle.read().decode())
-        mm = MMCIF2Dict(z)
-    return mm
+class TargetPCache(object):
+    """ An on-disk SQLite store of TargetP predictions.
 
+    Predictions are keyed by a hash of the sequence and the organism mode,
+    so that they can be re-used across runs and across structures that
+    share the same sequence.
+    """
 
-def read_gzipped_mmcif(name, filename):
-    from io import StringIO
+    def __init__(self, filename):
+        import sqlite3
 
-    # For unknown reasons, the gzipped file seems to be in bytes
-    # even if you specify mode = "r".
-    # Wrapping in a StringIO/TextIO is necessary
+        # The TargetP stage runs in a different thread to the one
+        # that opened the cache, but only one thread uses it at a time.
+        self.con = sqlite3.connect(filename, check_same_thread=False)
+        self.con.execute(
+            "CREATE TABLE IF NOT EXISTS targetp ("
+            "hash BLOB NOT NULL, "
+            "mode TEXT NOT NULL, "
+            "record TEXT NOT NULL, "
+            "PRIMARY KEY (hash, mode)"
+            ") WITHOUT ROWID"
+        )
+        self.con.commit()
+        return
 
-    parser = MMCIFParser()
-    with gzip.open(filename, mode="rb") as handle:
-        z = StringIO(handle.read().decode())
-        mm = parser.get_structure(name, z)
-    return mm
+    @staticmethod
+    def hash_seq(seq: str) -> bytes:
+        from hashlib import sha256
+        return sha256(seq.encode()).digest()
 
+    @staticmethod
+    def mode(plant: bool) -> str:
+        return "pl" if plant else "non-pl"
+
+    def get(self, hashes, plant=False):
+        """ Returns a dict of hash -> prediction for the hashes we have.
+
+        The id of the returned predictions is the hex of the hash.
+        """
+        import json
+
+        cls = TargetPPlant if plant else TargetP
+        mode = self.mode(plant)
+        hashes = list(hashes)
+
+        out = dict()
+        # Keep below SQLite's limit on the number of query parameters.
+        for i in range(0, len(hashes), 500):
+            batch = hashes[i:i + 500]
+            placeholders = ",".join("?" * len(batch))
+            cursor = self.con.execute(
+                f"SELECT hash, record FROM targetp WHERE mode = ? AND hash IN ({placeholders})",
+                [mode, *batch]
+            )
+            for hash_, record in cursor:
+                out[hash_] = cls(hash_.hex(), *json.loads(record))
+        return out
+
+    def put(self, predictions, plant=False):
+        """ Store a dict of hash -> prediction. """
+        import json
+
+        mode = self.mode(plant)
+        with self.con:
+            self.con.executemany(
+                "INSERT OR REPLACE INTO targetp (hash, mode, record) VALUES (?, ?, ?)",
+                [
+                    (hash_, mode, json.dumps(list(tp[1:])))
+                    for hash_, tp
+                    in predictions.items()
+                ]
+            )
+        return
 
-# This is just for consistency with the gzipped variants
-def read_mmcif_dict(filename):
-    if test_if_gzipped(filename):
-        return read_gzipped_mmcif_dict(filename)
-    else:
-        return MMCIF2Dict(filename)
+    def close(self):
+        self.con.close()
+        return
 
 
-# This is just for consistency with the gzipped variants
-def read_mmcif(name, filename):
-    if test_if_gzipped(filename):
-        return read_gzipped_mmcif(name, filename)
+def run_targetp_cached(seqs, plant=False, cmd="targetp", cache=None, workers=None, fifo=False):
+    """ Like run_targetp, but only runs each distinct sequence once.
+
+    If a TargetPCache is provided, sequences that are already in the cache
+    aren't sent to TargetP at all, and new predictions are added to it.
+    """
+    # Group the ids by sequence hash so we only predict each sequence once.
+    groups: dict[bytes, list[str]] = dict()
+    unique: dict[bytes, tuple[str, str]] = dict()
+    for id_, seq in seqs:
+        hash_ = TargetPCache.hash_seq(seq)
+        if hash_ not in groups:
+            groups[hash_] = []
+            unique[hash_] = (hash_.hex(), seq)
+        groups[hash_].append(id_)
+
+    if cache is None:
+        predictions = dict()
     else:
-        parser = MMCIFParser()
-        return parser.get_structure(name, filename)
+        predictions = cache.get(groups.keys(), plant=plant)
 
+    misses = [rec for hash_, rec in unique.items() if hash_ not in predictions]
 
-def write_compressed_pdb(writer, filename, select):
-    # The PDB writer can't write binary streams, so need this hack for now.
+    if len(misses) > 0:
+        new = run_targetp(misses, plant=plant, cmd=cmd, workers=workers, fifo=fifo)
+        new = {bytes.fromhex(id_): tp for id_, tp in new.items()}
 
-    from io import StringIO
+        if cache is not None:
+            cache.put(new, plant=plant)
 
-    sio = StringIO()
-    writer.save(sio, select)
-    sio.seek(0)
+        predictions.update(new)
 
-    with gzip.open(filename, "wb") as handle:
-        handle.write(sio.read().encode())
+    matches = dict()
+    for hash_, ids in groups.items():
+        tp = predictions.get(hash_, None)
+        if tp is None:
+            continue
 
+        for id_ in ids:
+            matches[id_] = tp._replace(id=id_)
 
-def trim_em(outdir, structure_data, targetp_results, minsize, compress=False):
-    writer = PDBIO()
+    return matches
 
-    makedirs(outdir, exist_ok=True)
 
-    for id_, sdata in structure_data.items():
+class Prediction(NamedTuple):
+    """ A cleavage site from an external predictor.
 
-        tp = targetp_results.get(id_, None)
-        filename = sdata.filename
-        bname, ext = splitext(basename(filename))
-        if ext == ".gz":
-            bname, _ = splitext(bname) 
+    This only has the fields of TargetP and TargetPPlant that trim_em uses.
+    """
 
-        if (tp is None) or (tp.cs is None):
-            ltrim = sdata.left_trim
-        else:
-            # Should I raise a warning if cs > left_trim?
-            ltrim = max([sdata.left_trim, tp.cs])
+    id: str
+    cs: int | None
 
-        rtrim = sdata.right_trim
 
-        if rtrim - ltrim < minsize:
-            print(
-                f"WARNING: After trimming {basename(filename)} "
-                f"had only {rtrim - ltrim} residues left. skipping"
-            )
-            continue
+# AlphaFold DB ids are like AF-P12345-F1, external tables often use the accession.
+AF_ID_REGEX = re.compile(r"^AF-(?P<accession>.+)-F\d+(-model_v\d+)?$")
 
-        cif = read_mmcif(id_, filename)
 
-        assert len(list(cif.get_chains())) == 1
+class PredictionTable(object):
+    """ A lookup of precomputed cleavage sites, from e.g. TargetP, SignalP6 or DeepTMHMM.
 
-        writer.set_structure(cif)
+    The table is a tab separated file with the protein id and the cleavage site
+    in the first two columns. The cleavage site uses the same convention as
+    TargetP, i.e. Y from "CS pos: X-Y" (the first residue of the mature protein,
+    counting from 1), which is also the cs column of --report-only.
+    An empty cleavage site (or ".", "-", "NA") means that there's no signal peptide.
+    Lines starting with "#" and a header line are ignored.
 
-        if compress:
-            write_compressed_pdb(writer, pjoin(outdir, f"{bname}.pdb.gz"), MMCIFSelect(ltrim, rtrim))
-        else:
-            writer.save(pjoin(outdir, f"{bname}.pdb"), MMCIFSelect(ltrim, rtrim))
+    The table is indexed into an SQLite file (next to it by default) the
+    first time it's used, so tables with many millions of rows don't need
+    to be held in memory. The index is rebuilt if the table changes.
+    If several runs start at once, one builds the index while the
+    others wait for it.
+    """
 
-    return
+    MISSING = {"", ".", "-", "NA", "None"}
 
+    # How many seconds to wait for another process to build the index.
+    BUILD_TIMEOUT = 3600
 
-def process_batch(
-    structure_filenames,
-    outdir,
-    lddt_threshold,
-    lddt_window_size,
-    plant,
-    targetp_cmd,
-    minsize,
-    compress=False
-):
-    structure_data: dict[str, MMCIFData] = dict()
+    def __init__(self, filename, index=None):
+        import sqlite3
+
+        self.filename = filename
+
+        if index is None:
+            index = f"{filename}.sqlite"
+
+        self.index = index
+
+        # Lookups happen in the TargetP stage thread, one thread at a time.
+        self.con = sqlite3.connect(index, timeout=self.BUILD_TIMEOUT, check_same_thread=False)
+
+        if not self.is_current():
+            self.build()
+        return
+
+    def signature(self):
+        st = os.stat(self.filename)
+        return f"{st.st_size}:{st.st_mtime_ns}"
+
+    def is_current(self) -> bool:
+        import sqlite3
 
-    for filename in structure_filenames:
+        try:
+            row = self.con.execute(
+                "SELECT value FROM meta WHERE key = 'signature'"
+            ).fetchone()
+        except sqlite3.OperationalError:
+            return False
+
+        return (row is not None) and (row[0] == self.signature())
+
+    def iter_table(self):
+        with open_text(self.filename) as handle:
+            for i, line in enumerate(handle):
+                if line.startswith("#") or (line.strip() == ""):
+                    continue
+
+                sline = line.rstrip("\r\n").split("\t")
+                if len(sline) < 2:
+                    raise ValueError(
+                        f"Line {i + 1} of {self.filename} should have an id and a cleavage site."
+                    )
+
+                id_, cs = sline[0].strip(), sline[1].strip()
+                if cs in self.MISSING:
+                    yield id_, None
+                    continue
+
+                try:
+                    yield id_, int(cs)
+                except ValueError:
+                    # Allow a header line.
+                    if i == 0:
+                        continue
+                    raise ValueError(
+                        f"Line {i + 1} of {self.filename} has a cleavage site that isn't an integer. "
+                        f"Got {cs}."
+                    )
+        return
 
+    def build(self):
+        from itertools import islice
+
+        signature = self.signature()
+
+        # Take the write lock before checking again, so that runs starting
+        # at the same time don't all rebuild the index over each other.
+        self.con.execute("BEGIN EXCLUSIVE")
         try:
-            mm = MMCIFData.from_file(
-                filename,
-                lddt_threshold=lddt_threshold,
-                lddt_window_size=lddt_window_size
+            if self.is_current():
+                self.con.commit()
+                return
+
+            self.con.execute("DROP TABLE IF EXISTS predictions")
+            self.con.execute("DROP TABLE IF EXISTS meta")
+            self.con.execute(
+                "CREATE TABLE predictions ("
+                "id TEXT NOT NULL PRIMARY KEY, "
+                "cs INTEGER"
+                ") WITHOUT ROWID"
+            )
+            self.con.execute(
+                "CREATE TABLE meta (key TEXT NOT NULL PRIMARY KEY, value TEXT)"
             )
-            structure_data[mm.id] = mm
-        except Exception as e:
-            if str(e).startswith("None of the sequence in"):
-                print(f"WARNING: {str(e)}")
-                continue
-            raise ValueError(f"Got an error while processing {filename}: {str(e)}")
 
-    if len(structure_data) == 0:
+            rows = self.iter_table()
+            while True:
+                batch = list(islice(rows, 100000))
+                if len(batch) == 0:
+                    break
+
+                self.con.executemany(
+                    "INSERT OR REPLACE INTO predictions (id, cs) VALUES (?, ?)",
+                    batch
+                )
+
+            # Written last, so a half built index is never used.
+            self.con.execute(
+                "INSERT INTO meta (key, value) VALUES ('signature', ?)",
+                [signature]
+            )
+            self.con.commit()
+        except BaseException:
+            self.con.rollback()
+            raise
         return
 
-    if targetp_cmd is not None:
-        targetp_results = run_targetp(
-            [sd.seq for sd in structure_data.values()],
-            plant=plant,
-            cmd=targetp_cmd
-        )
-    else:
-        targetp_results = dict()
+    def get(self, ids):
+        """ Returns a dict of id -> Prediction for the ids in the table.
+
+        AlphaFold ids (e.g. AF-P12345-F1) are also looked up by their accession.
+        """
+        keys = dict()
+        for id_ in ids:
+            keys.setdefault(id_, []).append(id_)
+
+            match = AF_ID_REGEX.match(id_)
+            if match is not None:
+                keys.setdefault(match["accession"], []).append(id_)
+
+        found = dict()
+        names = list(keys.keys())
+
+        # Keep below SQLite's limit on the number of query parameters.
+        for i in range(0, len(names), 500):
+            batch = names[i:i + 500]
+            placeholders = ",".join("?" * len(batch))
+            cursor = self.con.execute(
+                f"SELECT id, cs FROM predictions WHERE id IN ({placeholders})",
+                batch
+            )
+            for key, cs in cursor:
+                found[key] = cs
+
+        out = dict()
+        for key, cs in found.items():
+            for id_ in keys[key]:
+                # An exact match wins over the accession.
+                if (id_ in out) and (key != id_):
+                    continue
+                out[id_] = Prediction(id_, cs)
+        return out
+
+    def close(self):
+        self.con.close()
+        return
 
-    trim_em(outdir, structure_data, targetp_results, minsize, compress)
-    return
 
+# Everything we need to find the trim points, without the coordinates.
+REPORT_CATEGORIES = ("_entry", "_entity_poly", "_ma_qa_metric_local")
 
-def cli():
-    import argparse
 
-    parser = argparse.ArgumentParser(
-        prog="trim_alphafold_cifs",
-        description="Remove low confidence ends and signal peptides from alphafold structures."
-    )
+def pack_atom_site(d, start=None, end=None):
+    """ Pull the _atom_site records out of a parsed mmCIF as compact columns.
 
-    parser.add_argument(
-        "infiles",
-        type=argparse.FileType('r'),
-        help=(
-            "A new-line delimited file containing CIF file paths to process. "
-            "These can be gzipped. "
-            "Use '-' to take from stdin."
-        )
-    )
+    Each column becomes a numpy array of fixed width byte strings, which is
+    a tenth or so of the size of a list of python strings, and is cheap to
+    send between processes. The values are kept as text so that the
+    written structures are exactly the same as from the original strings.
+    If start and end are given, only the atoms of residues in [start, end)
+    are kept.
+    """
+    import numpy as np
 
-    parser.add_argument(
-        "-o", "--outdir",
-        type=str,
-        default="processed_pdbs",
-        help="Where to store the processed PDB files. Default: 'processed_pdbs'.",
-    )
+    atom_site = {k: v for k, v in d.items() if k.startswith("_atom_site.")}
 
-    parser.add_argument(
-        "-g", "--compress",
-        default=False,
-        action="store_true",
-        help="Should we gzip compress the output PDB files for you?",
-    )
+    if start is None:
+        rows = None
+    elif start >= end:
+        rows = []
+    else:
+        rows = select_atom_rows(atom_site, start, end)
 
+    packed = dict()
+    for key, values in atom_site.items():
+        if rows is not None:
+            values = [values[i] for i in rows]
+        packed[key] = np.array([v.encode() for v in values], dtype=np.bytes_)
+    return packed
 
-    parser.add_argument(
-        "-t", "--threshold",
-        type=float,
-        default=70,
-        help="The LDDT threshold to use for trimming low quality ends [1-100]. Default: 70"
-    )
 
-    parser.add_argument(
-        "-w", "--window",
-        type=int,
-        default=3,
-        help=(
-            "The size of the sliding window to use to remove low quality ends. "
-            "1 will stop trimming after encountering the first residue passing the threshold. "
-            "Default: 3."
-        )
-    )
+def unpack_atom_site(packed):
+    """ Turn packed _atom_site columns back into lists of strings. """
+    # This is a lot quicker than np.char.decode.
+    return {k: [v.decode() for v in column.tolist()] for k, column in packed.items()}
 
-    parser.add_argument(
-        "--plant",
-        default=False,
-        action="store_true",
-        help="Should we run TargetP with the plant models? NB if sequences are a mix, use the plant model."
-    )
 
-    parser.add_argument(
-        "--targetp",
-        type=str,
-        nargs="?",
-        const="targetp",
-        default=None,
-        help=(
-            "Specify a specific path to look for the targetp2 executable. "
-            "By default it will not run targetp. If you specify '--targetp' but no path, it will look in your PATH."
-        )
-    )
+PDB_ATOM_FORMAT = "%s%5i %-4s%c%3s %c%4i%c   %8.3f%8.3f%8.3f%6.2f%s      %4s%2s%2s\n"
+PDB_TER_FORMAT = "TER   %5i      %3s %c%4i%c                                                      \n"
 
-    parser.add_argument(
-        "-c", "--chunksize",
-        type=int,
-        default=1000,
-        help=(
-            "How many structures should we process at a time? "
-            "Running TargetP with too few or too many sequences (>5000) at a time is slow. "
-            "This is also important for memory consumption, as all of the structures have to be stored."
-            "Default: 1000"
-        )
-    )
+# mmCIF uses these for values that are missing or not applicable.
+MMCIF_UNASSIGNED = {".", "?"}
 
-    parser.add_argument(
-        "-m", "--minsize",
-        type=int,
-        default=10,
-        help="Filter out structures with fewer than this many AAs after trimming."
-    )
 
+def format_b_factor(value: float) -> str:
+    # Same rules as Biopython uses to fit the B-factor into 6 characters.
+    if value < 1e4:
+        if len(f"{value:.2f}") > 6:
+            return f"{value:6.1f}"
+        return f"{value:6.2f}"
+    elif value < 1e5:
+        if len(f"{value:.1f}") > 6:
+            return f"{value:6.0f}"
+        return f"{value:6.1f}"
+    elif value < 1e6:
+        return f"{int(value):6d}"
+    return f"{999999:6d}"
 
-    return parser.parse_args()
 
+def select_atom_rows(atom_site, start, end):
+    """ Find the _atom_site rows for residues in [start, end).
 
-def main():
-    args = cli()
+    Residue indices are 0-based, and are taken from the author sequence
+    numbers if they're present (which is what Biopython does).
+    """
+    if "_atom_site.auth_seq_id" in atom_site:
+        seq_ids = atom_site["_atom_site.auth_seq_id"]
+    else:
+        seq_ids = atom_site["_atom_site.label_seq_id"]
 
-    infiles = [
-        l.strip()
-        for l
-        in args.infiles
-        if l.strip() != ""
-    ]
+    chains = atom_site.get("_atom_site.auth_asym_id", atom_site["_atom_site.label_asym_id"])
+    assert len(set(chains)) == 1, "Expected the structure to have a single chain."
 
-    # I don't want any really small chunks left over at the end
-    minsize = round(args.chunksize / 10)
+    models = atom_site.get("_atom_site.pdbx_PDB_model_num", None)
+    assert (models is None) or (len(set(models)) == 1), "Expected the structure to have a single model."
 
-    for i in range(0, len(infiles), args.chunksize):
-        if (i + args.chunksize + minsize) > len(infiles):
-            j = len(infiles)
-            should_break = True
-        else:
-            j = i + args.chunksize
-            should_break = False
+    rows = []
+    for i, seq_id in enumerate(seq_ids):
+        # Atoms without a residue number aren't part of the polymer.
+        if seq_id == ".":
+            continue
 
-        process_batch(
-            infiles[i:j],
-            args.outdir,
-            args.threshold,
-            args.window,
-            args.plant,
-            args.targetp,
-            args.minsize,
-            args.compress
+        index = int(seq_id) - 1
+        if start <= index < end:
+            rows.append(i)
+    return rows
+
+
+def iter_trimmed_pdb_lines(atom_site, start, end):
+    """ Generate PDB formatted lines for residues in [start, end).
+
+    The output is the same as PDBIO from a structure parsed with MMCIFParser.
+    """
+    import numpy as np
+
+    rows = select_atom_rows(atom_site, start, end)
+
+    if "_atom_site.auth_seq_id" in atom_site:
+        seq_ids = atom_site["_atom_site.auth_seq_id"]
+    else:
+        seq_ids = atom_site["_atom_site.label_seq_id"]
+
+    chains = atom_site.get("_atom_site.auth_asym_id", atom_site["_atom_site.label_asym_id"])
+    groups = atom_site["_atom_site.group_PDB"]
+    names = atom_site["_atom_site.label_atom_id"]
+    altlocs = atom_site["_atom_site.label_alt_id"]
+    resnames = atom_site["_atom_site.label_comp_id"]
+    icodes = atom_site["_atom_site.pdbx_PDB_ins_code"]
+    occupancies = atom_site["_atom_site.occupancy"]
+    bfactors = atom_site["_atom_site.B_iso_or_equiv"]
+    elements = atom_site.get("_atom_site.type_symbol", None)
+
+    # Biopython stores coordinates as single precision floats,
+    # so we round them the same way to get identical output.
+    coords = np.array(
+        [
+            [atom_site["_atom_site.Cartn_x"][i] for i in rows],
+            [atom_site["_atom_site.Cartn_y"][i] for i in rows],
+            [atom_site["_atom_site.Cartn_z"][i] for i in rows],
+        ],
+        dtype=np.float64
+    ).astype(np.float32).T.tolist()
+
+    atom_number = 1
+    for i, (x, y, z) in zip(rows, coords):
+        if atom_number > 99999:
+            raise ValueError("Atom serial number exceeds the PDB format limit.")
+
+        element = "" if elements is None else elements[i]
+        if element in MMCIF_UNASSIGNED:
+            element = ""
+        element = element.strip().upper()
+
+        name = names[i].strip()
+        if len(name) < 4 and name[:1].isalpha() and len(element) < 2:
+            name = " " + name
+
+        altloc = " " if altlocs[i] in MMCIF_UNASSIGNED else altlocs[i]
+        icode = " " if icodes[i] in MMCIF_UNASSIGNED else icodes[i]
+        resname = resnames[i]
+        chain = chains[i]
+        resseq = int(seq_ids[i])
+
+        yield PDB_ATOM_FORMAT % (
+            "HETATM" if groups[i] == "HETATM" else "ATOM  ",
+            atom_number,
+            name,
+            altloc,
+            resname,
+            chain,
+            resseq,
+            icode,
+            x,
+            y,
+            z,
+            float(occupancies[i]),
+            format_b_factor(float(bfactors[i])),
+            " ",
+            element.rjust(2),
+            "  ",
         )
+        atom_number += 1
 
-        if should_break:
-            break
+    if len(rows) > 0:
+        yield PDB_TER_FORMAT % (atom_number, resname, chain, resseq, icode)
+
+    yield "END   \n"
+    return
+
+
+def quote_mmcif_value(value: str) -> str:
+    if value in MMCIF_UNASSIGNED:
+        return value
+    elif (
+        (value == "")
+        or any(c.isspace() for c in value)
+        or (value[0] in "_#$'\"[];")
+    ):
+        return f'"{value}"' if "'" in value else f"'{value}'"
+    return value
+
+
+def iter_trimmed_mmcif_lines(name, atom_site, start, end):
+    """ Generate mmCIF formatted lines for residues in [start, end).
+
+    Only the _atom_site records are written.
+    """
+    rows = select_atom_rows(atom_site, start, end)
+    columns = list(atom_site.values())
+
+    yield f"data_{name}\n#\n_entry.id {quote_mmcif_value(name)}\n#\nloop_\n"
+    for key in atom_site.keys():
+        yield f"{key}\n"
+
+    for i in rows:
+        yield " ".join(quote_mmcif_value(column[i]) for column in columns) + "\n"
+
+    yield "#\n"
+    return
+
+
+class JournalRecord(NamedTuple):
+
+    input: str
+    status: str
+    output: str | None
+    left_trim: int | None
+    right_trim: int | None
+    size: int | None
+    # Only set for structures written to shard archives.
+    offset: int | None = None
+
+
+class Journal(object):
+    """ Keeps track of which input files have been finished.
+
+    Records are appended to a JSON lines file once a whole chunk has been
+    written, so that a killed run can be resumed without redoing the
+    inputs that were already finished.
+
+    The file is never truncated, and each chunk is added with a single
+    write to a file opened in append mode. So several runs (e.g. from GNU
+    parallel) can share a journal without losing each other's records.
+    """
+
+    def __init__(self, filename, resume=False):
+        self.filename = filename
+        self.done: dict[str, JournalRecord] = dict()
+
+        if resume and isfile(filename):
+            self.load(filename)
+
+        # Unbuffered, so that each chunk goes in one write call.
+        self.handle = open(filename, "ab", buffering=0)
+
+        # Make sure a torn line from a killed run doesn't swallow the next record.
+        if os.path.getsize(filename) > 0:
+            with open(filename, "rb") as handle:
+                handle.seek(-1, os.SEEK_END)
+                if handle.read(1) != b"\n":
+                    self.handle.write(b"\n")
+        return
+
+    def load(self, filename):
+        import json
+
+        with open(filename, "r") as handle:
+            for line in handle:
+                try:
+                    record = JournalRecord(**json.loads(line))
+                except (ValueError, TypeError):
+                    # Probably a partially written line from a killed run.
+                    continue
+
+                self.done[record.input] = record
+        return
+
+    def is_done(self, filename):
+        """ Was this input finished in a previous run?
+
+        Inputs that were written are only counted as done if their output
+        is still there and is the size that we wrote.
+        """
+        record = self.done.get(filename, None)
+
+        if record is None:
+            return False
+        elif record.status == "skipped":
+            return True
+        elif record.offset is not None:
+            # Archives are only appended to, so the member is still intact
+            # if the archive extends past its end.
+            archive, _ = record.output.split("::", 1)
+            return (
+                isfile(archive)
+                and (os.path.getsize(archive) >= record.offset + record.size)
+            )
+
+        return (
+            isfile(record.output)
+            and (os.path.getsize(record.output) == record.size)
+        )
+
+    def write(self, records):
+        import json
+
+        # Write the chunk in one go and sync it, so that the journal is
+        # never ahead of the files that are actually on disk.
+        text = "".join(json.dumps(r._asdict()) + "\n" for r in records)
+        self.handle.write(text.encode())
+        os.fsync(self.handle.fileno())
+        return
+
+    def close(self):
+        self.handle.close()
+        return
+
+
+class Timed(object):
+    """ Wraps a function to also return the CPU time that the call took.
+
+    This measures the calling thread, so it works in worker processes
+    and in the pipeline threads alike.
+    """
+
+    def __init__(self, fn):
+        self.fn = fn
+        return
+
+    def __call__(self, *args):
+        from time import thread_time
+
+        start = thread_time()
+        result = self.fn(*args)
+        return result, thread_time() - start
+
+
+class ChunkStats(object):
+    """ Timing and throughput statistics for a single chunk.
+
+    Each stage records the wall time and the CPU time spent in this process
+    and in any worker processes or subprocesses.
+    If a handle is given, write() appends the stats as a JSON line.
+    """
+
+    def __init__(self, chunk, handle=None):
+        self.chunk = chunk
+        self.handle = handle
+        self.filenames = []
+        self.stages = dict()
+        self.counts = {
+            "inputs": 0,
+            "parsed": 0,
+            "skipped": 0,
+            "written": 0,
+            "residues": 0,
+            "output_bytes": 0,
+        }
+        return
+
+    @contextmanager
+    def stage(self, name):
+        from time import perf_counter, thread_time
+
+        wall = perf_counter()
+        cpu = thread_time()
+        try:
+            yield
+        finally:
+            self.add(name, perf_counter() - wall, thread_time() - cpu)
+        return
+
+    def add(self, name, wall=0.0, cpu=0.0):
+        stage = self.stages.setdefault(name, {"wall": 0.0, "cpu": 0.0})
+        stage["wall"] += wall
+        stage["cpu"] += cpu
+        return
+
+    def to_dict(self):
+        from structure_io import input_size
+
+        # Only stat the inputs if we're actually writing the stats out.
+        input_bytes = sum(input_size(f) for f in self.filenames)
+
+        def rate(value, stage):
+            wall = self.stages.get(stage, {}).get("wall", 0.0)
+            return (value / wall) if wall > 0 else None
+
+        return {
+            "chunk": self.chunk,
+            **self.counts,
+            "input_bytes": input_bytes,
+            "stages": self.stages,
+            "residues_per_second": rate(self.counts["residues"], "parse"),
+            "input_bytes_per_second": rate(input_bytes, "parse"),
+            "output_bytes_per_second": rate(self.counts["output_bytes"], "write"),
+        }
+
+    def write(self):
+        import json
+
+        if self.handle is None:
+            return
+
+        self.handle.write(json.dumps(self.to_dict()) + "\n")
+        self.handle.flush()
+        return
+
+
+def pool_map(executor, fn, *iterables):
+    """ Map fn over the iterables, in parallel if we have an executor.
+
+    Results are always returned in input order, so the output is the same
+    however many processes we use.
+    """
+    if executor is None:
+        return map(fn, *iterables)
+
+    iterables = [list(it) for it in iterables]
+    nitems = min(map(len, iterables), default=0)
+    chunksize = max(1, nitems // (executor._max_workers * 4))
+    return executor.map(fn, *iterables, chunksize=chunksize)
+
+
+def iter_trimmed_lines(id_, atom_site, ltrim, rtrim, outformat="pdb"):
+    """ Format the residues in [ltrim, rtrim) of a packed _atom_site. """
+    atom_site = unpack_atom_site(atom_site)
+
+    if outformat == "pdb":
+        return iter_trimmed_pdb_lines(atom_site, ltrim, rtrim)
+    elif outformat == "cif":
+        return iter_trimmed_mmcif_lines(id_, atom_site, ltrim, rtrim)
+    else:
+        raise ValueError(f"Unknown output format {outformat}.")
+
+
+PARTIAL_DIR_PREFIX = ".partial-"
+
+
+@contextmanager
+def partial_dir(outdir):
+    """ A temporary folder in outdir to write the outputs into before they're finished.
+
+    The folder is locked while it's in use, so that remove_stale_partial_dirs
+    in another run writing to the same outdir leaves it alone.
+    It is removed when we're done, but if the run gets killed it's
+    left for the next run to clean up.
+    """
+    import fcntl
+    from tempfile import mkdtemp
+
+    path = mkdtemp(prefix=PARTIAL_DIR_PREFIX, dir=outdir)
+
+    # The lock file only gets its real name once it's locked,
+    # otherwise another run could find it unlocked in the meantime.
+    lock = open(pjoin(path, "lock.new"), "w")
+    fcntl.flock(lock, fcntl.LOCK_EX)
+    os.rename(pjoin(path, "lock.new"), pjoin(path, "lock"))
+
+    try:
+        yield path
+    finally:
+        shutil.rmtree(path, ignore_errors=True)
+        lock.close()
+    return
+
+
+def remove_stale_partial_dirs(outdir):
+    """ Remove the partial_dir folders left in outdir by runs that were killed. """
+    import fcntl
+
+    for entry in os.scandir(outdir):
+        if not (entry.name.startswith(PARTIAL_DIR_PREFIX) and entry.is_dir()):
+            continue
+
+        try:
+            lock = open(pjoin(entry.path, "lock"), "r")
+        except FileNotFoundError:
+            # Either it was just removed, or it isn't locked yet.
+            continue
+
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            # Another run is still using it.
+            lock.close()
+            continue
+
+        shutil.rmtree(entry.path, ignore_errors=True)
+        lock.close()
+    return
+
+
+def write_trimmed_structure(
+    outfile,
+    id_,
+    atom_site,
+    ltrim,
+    rtrim,
+    compress=False,
+    outformat="pdb",
+    tmpdir=None
+):
+    lines = iter_trimmed_lines(id_, atom_site, ltrim, rtrim, outformat)
+
+    # Write to a temporary file first, so that if we get killed part way
+    # through there's never a half written file at outfile.
+    if tmpdir is None:
+        partial = f"{outfile}.partial"
+    else:
+        partial = pjoin(tmpdir, basename(outfile))
+
+    with open_output(partial, compress=compress, mode="wt") as handle:
+        handle.writelines(lines)
+
+    os.replace(partial, outfile)
+    return os.path.getsize(outfile)
+
+
+def render_trimmed_structure(id_, atom_site, ltrim, rtrim, compress=False, outformat="pdb"):
+    """ Like write_trimmed_structure, but returns the file contents as bytes. """
+    from structure_io import gzip
+
+    lines = iter_trimmed_lines(id_, atom_site, ltrim, rtrim, outformat)
+    data = "".join(lines).encode()
+
+    if compress:
+        data = gzip.compress(data)
+    return data
+
+
+class ShardWriter(object):
+    """ Appends structures to a fixed number of tar archives.
+
+    Each structure goes to a shard chosen from a hash of its id, and an
+    index.tsv file records the shard, member name, and byte offset and
+    size of the data so that single structures can be read back without
+    scanning the archive. If an id is written more than once
+    (e.g. after a resumed run), the last row in the index is the current one.
+
+    A run that gets killed leaves shards without the end of archive blocks,
+    and maybe with a partly written member at the end. So existing shards
+    are cut back to the end of their last complete member before new
+    members are appended. The index rows are only written once the shards
+    are flushed, so they never point at data that isn't on disk.
+
+    Only one process can write shards to a folder at a time, so a lock
+    file is held until the writer is closed.
+    """
+
+    def __init__(self, outdir, nshards):
+        import fcntl
+
+        self.outdir = outdir
+        self.nshards = nshards
+        self.tars = dict()
+        self.rows = []
+
+        makedirs(outdir, exist_ok=True)
+
+        # The lock goes away with the process, even if it gets killed.
+        self.lock = open(pjoin(outdir, "shards.lock"), "a")
+        try:
+            fcntl.flock(self.lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            self.lock.close()
+            raise ValueError(
+                f"Another process is already writing shards to {outdir}. "
+                "Runs using --shards at the same time need different --outdir folders."
+            )
+
+        self.index = open(pjoin(outdir, "index.tsv"), "a")
+        if self.index.tell() == 0:
+            self.index.write("id\tshard\tmember\toffset\tsize\n")
+        return
+
+    @staticmethod
+    def members_end(path) -> int:
+        """ The offset just after the last complete member in a tar archive. """
+        import tarfile
+
+        size = os.path.getsize(path)
+        end = 0
+        try:
+            with tarfile.open(path, mode="r:") as tar:
+                for info in tar:
+                    nblocks = -(-info.size // tarfile.BLOCKSIZE)
+                    data_end = info.offset_data + (nblocks * tarfile.BLOCKSIZE)
+                    if data_end > size:
+                        break
+
+                    end = data_end
+                    tar.members = []
+        except tarfile.ReadError:
+            # An empty shard, or a header or data cut off part way through.
+            pass
+        return end
+
+    def open_shard(self, path):
+        import tarfile
+
+        if isfile(path):
+            handle = open(path, "r+b")
+            handle.seek(self.members_end(path))
+            handle.truncate()
+        else:
+            handle = open(path, "w+b")
+
+        # The tarfile starts writing from the current position of the handle.
+        return tarfile.open(fileobj=handle, mode="w", format=tarfile.PAX_FORMAT)
+
+    def shard_path(self, id_):
+        from zlib import crc32
+
+        shard = crc32(id_.encode()) % self.nshards
+        return pjoin(self.outdir, f"shard_{shard:05d}.tar")
+
+    def add(self, id_, member, data):
+        """ Add a structure, returning the shard path and offset of the data. """
+        import tarfile
+        import time
+        from io import BytesIO
+
+        path = self.shard_path(id_)
+        if path not in self.tars:
+            self.tars[path] = self.open_shard(path)
+
+        tar = self.tars[path]
+
+        info = tarfile.TarInfo(member)
+        info.size = len(data)
+        info.mtime = int(time.time())
+        tar.addfile(info, BytesIO(data))
+
+        # The data is padded out to a whole number of blocks after the header.
+        nblocks = -(-len(data) // tarfile.BLOCKSIZE)
+        offset = tar.offset - (nblocks * tarfile.BLOCKSIZE)
+
+        self.rows.append(f"{id_}\t{basename(path)}\t{member}\t{offset}\t{len(data)}\n")
+        return path, offset
+
+    def flush(self):
+        for tar in self.tars.values():
+            tar.fileobj.flush()
+            os.fsync(tar.fileobj.fileno())
+
+        self.index.write("".join(self.rows))
+        self.rows = []
+        self.index.flush()
+        return
+
+    def close(self):
+        for tar in self.tars.values():
+            # This writes the end of archive blocks, but the handle
+            # belongs to us, so we have to close it too.
+            tar.close()
+            tar.fileobj.close()
+
+        self.tars = dict()
+        self.index.write("".join(self.rows))
+        self.rows = []
+        self.index.close()
+
+        # Closing the file releases the lock.
+        self.lock.close()
+        return
+
+
+def trim_em(
+    outdir,
+    structure_data,
+    targetp_results,
+    minsize,
+    compress=False,
+    executor=None,
+    outformat="pdb",
+    shards=None,
+    stats=None
+):
+    """ Write out the trimmed structures.
+
+    If shards is a ShardWriter, the structures are added to its archives
+    rather than written as separate files.
+
+    Returns a list of JournalRecords saying what happened to each structure.
+    """
+    makedirs(outdir, exist_ok=True)
+
+    jobs = []
+    records = []
+    for id_, filename, left_trim, rtrim, atom_site in zip(
+        structure_data.ids,
+        structure_data.filenames,
+        structure_data.left_trims.tolist(),
+        structure_data.right_trims.tolist(),
+        structure_data.atom_sites
+    ):
+
+        tp = targetp_results.get(id_, None)
+        bname, ext = splitext(path_basename(filename))
+        if ext == ".gz":
+            bname, _ = splitext(bname) 
+
+        if (tp is None) or (tp.cs is None):
+            ltrim = left_trim
+        else:
+            # Should I raise a warning if cs > left_trim?
+            ltrim = max([left_trim, tp.cs])
+
+        if rtrim - ltrim < minsize:
+            print(
+                f"WARNING: After trimming {path_basename(filename)} "
+                f"had only {rtrim - ltrim} residues left. skipping"
+            )
+            records.append(JournalRecord(filename, "skipped", None, ltrim, rtrim, None))
+            continue
+
+        if compress:
+            outfile = f"{bname}.{outformat}.gz"
+        else:
+            outfile = f"{bname}.{outformat}"
+
+        if shards is None:
+            outfile = pjoin(outdir, outfile)
+
+        jobs.append((outfile, id_, atom_site, ltrim, rtrim, compress, outformat))
+        records.append(JournalRecord(filename, "written", outfile, ltrim, rtrim, None))
+
+    if len(jobs) == 0:
+        return records
+
+    worker_cpu = 0.0
+    if shards is None:
+        results = []
+        with partial_dir(outdir) as tmpdir:
+            for (outfile, *_), (size, cpu) in zip(
+                jobs,
+                pool_map(
+                    executor,
+                    Timed(write_trimmed_structure),
+                    *zip(*jobs),
+                    [tmpdir] * len(jobs)
+                )
+            ):
+                results.append((outfile, None, size))
+                worker_cpu += cpu
+    else:
+        # Only this process can append to the archives, but the
+        # formatting and compression can still happen in the workers.
+        rendered = pool_map(executor, Timed(render_trimmed_structure), *list(zip(*jobs))[1:])
+
+        results = []
+        for (member, id_, *_), (data, cpu) in zip(jobs, rendered):
+            path, offset = shards.add(id_, member, data)
+            results.append((f"{path}::{member}", offset, len(data)))
+            worker_cpu += cpu
+
+        # Make sure the archives are on disk before the journal says so.
+        shards.flush()
+
+    # Without a pool, the CPU time is already counted in this thread.
+    if (stats is not None) and (executor is not None):
+        stats.add("write", cpu=worker_cpu)
+
+    results = iter(results)
+    out = []
+    for r in records:
+        if r.status == "written":
+            output, offset, size = next(results)
+            r = r._replace(output=output, size=size, offset=offset)
+        out.append(r)
+    return out
+
+
+def read_structure_file(filename, atom_site=True, lddt_threshold=None, lddt_window_size=None):
+    # Wraps the error with the filename here so that it is still
+    # reported per file when we're running in a process pool.
+    try:
+        return MMCIFData.read(filename, atom_site, lddt_threshold, lddt_window_size)
+    except Exception as e:
+        raise ValueError(f"Got an error while processing {filename}: {str(e)}")
+
+
+def parse_batch(
+    structure_filenames,
+    lddt_threshold,
+    lddt_window_size,
+    executor=None,
+    stats=None,
+    atom_site=True
+):
+    """ Parse a chunk of structures and find their LDDT trim points.
+
+    Returns a StructureChunk of the structures that pass the LDDT thresholds,
+    and a list of (filename, message) tuples for those that don't.
+    If atom_site is False, the coordinates aren't read.
+    """
+    if stats is None:
+        stats = ChunkStats(None)
+
+    with stats.stage("parse"):
+        parsed = []
+        worker_cpu = 0.0
+        for mm, cpu in pool_map(
+            executor,
+            Timed(read_structure_file),
+            structure_filenames,
+            [atom_site] * len(structure_filenames),
+            # The workers find the trims, so they only send back the atoms that we'll write.
+            [lddt_threshold] * len(structure_filenames),
+            [lddt_window_size] * len(structure_filenames)
+        ):
+            parsed.append(mm)
+            worker_cpu += cpu
+
+        if executor is not None:
+            stats.add("parse", cpu=worker_cpu)
+
+        # The workers find the trims one structure at a time, rather than
+        # padding the whole chunk out to the longest structure.
+        chunk = StructureChunk.from_records(parsed)
+        del parsed
+
+    stats.filenames.extend(structure_filenames)
+    stats.counts["inputs"] += len(structure_filenames)
+    stats.counts["parsed"] += len(chunk)
+    stats.counts["residues"] += len(chunk.lddt)
+
+    skipped = []
+    # If several structures have the same id, this keeps the position of the
+    # first and the data of the last, like the dictionary it replaced.
+    keep = dict()
+    for i, (id_, filename, passes) in enumerate(zip(
+        chunk.ids,
+        chunk.filenames,
+        (chunk.left_trims <= chunk.right_trims).tolist()
+    )):
+        if passes:
+            keep[id_] = i
+        else:
+            skipped.append((filename, no_lddt_pass_message(filename)))
+
+    structure_data = chunk.select(list(keep.values()))
+    return structure_data, skipped
+
+
+def targetp_batch(
+    structure_data,
+    plant,
+    targetp_cmd,
+    targetp_cache=None,
+    stats=None,
+    targetp_workers=None,
+    targetp_fifo=False,
+    predictions=None
+):
+    """ Get the cleavage sites for the structures in a chunk.
+
+    If predictions (a PredictionTable) is given, the cleavage sites are
+    looked up in that instead of running TargetP.
+    """
+    import resource
+
+    if stats is None:
+        stats = ChunkStats(None)
+
+    if (predictions is not None) and (len(structure_data) > 0):
+        with stats.stage("predictions"):
+            return predictions.get(structure_data.ids)
+
+    if (targetp_cmd is None) or (len(structure_data) == 0):
+        return dict()
+
+    # TargetP runs as a subprocess, so its CPU time shows up in
+    # the usage of the children once they've finished.
+    before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    with stats.stage("targetp"):
+        results = run_targetp_cached(
+            list(structure_data.iter_seqs()),
+            plant=plant,
+            cmd=targetp_cmd,
+            cache=targetp_cache,
+            workers=targetp_workers,
+            fifo=targetp_fifo
+        )
+
+    after = resource.getrusage(resource.RUSAGE_CHILDREN)
+    stats.add(
+        "targetp",
+        cpu=(after.ru_utime - before.ru_utime) + (after.ru_stime - before.ru_stime)
+    )
+    return results
+
+
+def process_batch(
+    structure_filenames,
+    outdir,
+    lddt_threshold,
+    lddt_window_size,
+    plant,
+    targetp_cmd,
+    minsize,
+    compress=False,
+    executor=None,
+    targetp_cache=None,
+    journal=None,
+    outformat="pdb",
+    shards=None,
+    stats=None,
+    targetp_workers=None,
+    targetp_fifo=False,
+    predictions=None,
+    report=None
+):
+    """ Parse, predict and write out a chunk of structures.
+
+    If report is a text handle, a row of trim points is written there for
+    each structure instead of writing the trimmed structures.
+    """
+    structure_data, skipped = parse_batch(
+        structure_filenames,
+        lddt_threshold,
+        lddt_window_size,
+        executor,
+        stats,
+        atom_site=(report is None)
+    )
+
+    targetp_results = targetp_batch(
+        structure_data,
+        plant,
+        targetp_cmd,
+        targetp_cache,
+        stats,
+        targetp_workers,
+        targetp_fifo,
+        predictions
+    )
+
+    if report is not None:
+        report_batch(report, structure_data, skipped, targetp_results, stats)
+        return
+
+    write_batch(
+        outdir,
+        structure_data,
+        skipped,
+        targetp_results,
+        minsize,
+        compress,
+        executor,
+        journal,
+        outformat,
+        shards,
+        stats
+    )
+    return
+
+
+def write_batch(
+    outdir,
+    structure_data,
+    skipped,
+    targetp_results,
+    minsize,
+    compress=False,
+    executor=None,
+    journal=None,
+    outformat="pdb",
+    shards=None,
+    stats=None
+):
+    if stats is None:
+        stats = ChunkStats(None)
+
+    records = []
+    for filename, message in skipped:
+        print(f"WARNING: {message}")
+        records.append(JournalRecord(filename, "skipped", None, None, None, None))
+
+    with stats.stage("write"):
+        if len(structure_data) > 0:
+            records.extend(trim_em(
+                outdir,
+                structure_data,
+                targetp_results,
+                minsize,
+                compress,
+                executor,
+                outformat,
+                shards,
+                stats
+            ))
+
+        if journal is not None:
+            journal.write(records)
+
+    for record in records:
+        stats.counts[record.status] += 1
+        stats.counts["output_bytes"] += record.size or 0
+
+    stats.write()
+    return
+
+
+REPORT_COLUMNS = ["id", "ltrim", "cs", "rtrim", "length"]
+
+
+def report_batch(handle, structure_data, skipped, targetp_results, stats=None):
+    """ Write a row of trim points for each structure.
+
+    ltrim and rtrim are the 0-based start and (exclusive) end of the region
+    passing the LDDT thresholds, and cs is the TargetP cleavage site (empty if
+    there isn't one). The trimmed structure starts at max(ltrim, cs).
+    """
+    if stats is None:
+        stats = ChunkStats(None)
+
+    for filename, message in skipped:
+        print(f"WARNING: {message}")
+
+    with stats.stage("report"):
+        lines = []
+        for id_, ltrim, rtrim, length in zip(
+            structure_data.ids,
+            structure_data.left_trims.tolist(),
+            structure_data.right_trims.tolist(),
+            structure_data.lengths().tolist()
+        ):
+            tp = targetp_results.get(id_, None)
+            cs = "" if (tp is None) or (tp.cs is None) else tp.cs
+            lines.append(f"{id_}\t{ltrim}\t{cs}\t{rtrim}\t{length}\n")
+
+        text = "".join(lines)
+        handle.write(text)
+        handle.flush()
+
+    stats.counts["skipped"] += len(skipped)
+    stats.counts["written"] += len(lines)
+    stats.counts["output_bytes"] += len(text)
+    stats.write()
+    return
+
+
+def _targetp_stage(
+    parsed,
+    plant,
+    targetp_cmd,
+    targetp_cache,
+    stats,
+    targetp_workers=None,
+    targetp_fifo=False,
+    predictions=None
+):
+    # parsed is the future from the parsing stage.
+    structure_data, skipped = parsed.result()
+    targetp_results = targetp_batch(
+        structure_data,
+        plant,
+        targetp_cmd,
+        targetp_cache,
+        stats,
+        targetp_workers,
+        targetp_fifo,
+        predictions
+    )
+    return structure_data, skipped, targetp_results, stats
+
+
+def process_pipelined(
+    chunks,
+    outdir,
+    lddt_threshold,
+    lddt_window_size,
+    plant,
+    targetp_cmd,
+    minsize,
+    compress=False,
+    executor=None,
+    inflight=3,
+    targetp_cache=None,
+    journal=None,
+    outformat="pdb",
+    shards=None,
+    stats_handle=None,
+    targetp_workers=None,
+    targetp_fifo=False,
+    predictions=None,
+    report=None
+):
+    """ Like process_batch, but overlaps the stages of consecutive chunks.
+
+    Each stage has a single worker thread, so while TargetP runs on chunk N,
+    chunk N + 1 is being parsed and chunk N - 1 is being written.
+    At most `inflight` chunks are held in memory at once.
+    """
+    from collections import deque
+    from concurrent.futures import ThreadPoolExecutor
+
+    def write(predicted):
+        structure_data, skipped, targetp_results, stats = predicted.result()
+
+        if report is not None:
+            report_batch(report, structure_data, skipped, targetp_results, stats)
+            return
+
+        write_batch(
+            outdir,
+            structure_data,
+            skipped,
+            targetp_results,
+            minsize,
+            compress,
+            executor,
+            journal,
+            outformat,
+            shards,
+            stats
+        )
+        return
+
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=1) as parser, ThreadPoolExecutor(max_workers=1) as predictor:
+        try:
+            for i, chunk in enumerate(chunks):
+                stats = ChunkStats(i, stats_handle)
+                parsed = parser.submit(
+                    parse_batch,
+                    chunk,
+                    lddt_threshold,
+                    lddt_window_size,
+                    executor,
+                    stats,
+                    report is None
+                )
+                pending.append(predictor.submit(
+                    _targetp_stage,
+                    parsed,
+                    plant,
+                    targetp_cmd,
+                    targetp_cache,
+                    stats,
+                    targetp_workers,
+                    targetp_fifo,
+                    predictions
+                ))
+
+                if len(pending) >= inflight:
+                    write(pending.popleft())
+
+            while len(pending) > 0:
+                write(pending.popleft())
+        finally:
+            # If something went wrong, don't bother finishing the other chunks.
+            parser.shutdown(cancel_futures=True)
+            predictor.shutdown(cancel_futures=True)
+    return
+
+
+def cli():
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        prog="trim_alphafold_cifs",
+        description="Remove low confidence ends and signal peptides from alphafold structures."
+    )
+
+    parser.add_argument(
+        "infiles",
+        type=str,
+        nargs="+",
+        help=(
+            "CIF files, directories, or glob patterns (e.g. 'structures/**/*.cif.gz'). "
+            "Directories are searched recursively for files ending with .cif or .cif.gz. "
+            "Any other file is read as a new-line delimited list of CIF file paths to process. "
+            "These can be gzipped. "
+            "Tar archives (e.g. AlphaFold DB proteomes) are read directly, "
+            "and single members can be given as 'archive.tar::member.cif.gz'. "
+            "Use '-' to take the list from stdin."
+        )
+    )
+
+    parser.add_argument(
+        "-o", "--outdir",
+        type=str,
+        default="processed_pdbs",
+        help="Where to store the processed structure files. Default: 'processed_pdbs'.",
+    )
+
+    parser.add_argument(
+        "-f", "--outformat",
+        default="pdb",
+        choices=["pdb", "cif"],
+        help=(
+            "What format should the trimmed structures be written in? "
+            "The mmCIF output only contains the atom records. Default: pdb"
+        ),
+    )
+
+    parser.add_argument(
+        "--report-only",
+        type=str,
+        default=None,
+        help=(
+            "Don't write any structures, just write a TSV of the trim points to this file. "
+            "The columns are the id, the LDDT left trim, the TargetP cleavage site, "
+            "the LDDT right trim, and the sequence length. Trims are 0-based and the right trim is exclusive. "
+            "Only the sequence and LDDT values are read from each file, so this is much faster."
+        )
+    )
+
+    parser.add_argument(
+        "-g", "--compress",
+        default=False,
+        action="store_true",
+        help="Should we gzip compress the output PDB files for you?",
+    )
+
+
+    parser.add_argument(
+        "--shards",
+        type=int,
+        default=0,
+        help=(
+            "Instead of writing each structure to its own file, "
+            "append them to this many tar archives in --outdir. "
+            "An index.tsv file records the archive, byte offset and size of each structure, "
+            "so they can be read without unpacking the archive. "
+            "With --compress each structure is compressed separately. "
+            "Only one run at a time can write shards to an --outdir. "
+            "Default: 0, write separate files."
+        ),
+    )
+
+    parser.add_argument(
+        "--resume",
+        default=False,
+        action="store_true",
+        help=(
+            "Skip input files that were finished by a previous run with the same --journal. "
+            "Outputs that are missing or were only partially written are redone. "
+            "This turns on the journal if --journal isn't given."
+        ),
+    )
+
+    parser.add_argument(
+        "--journal",
+        type=str,
+        default=None,
+        help=(
+            "Keep track of the finished input files in this file, so that the run can be resumed later. "
+            "New records are appended, so several runs can share a journal. "
+            "By default there is no journal, unless --resume is given, "
+            "in which case it is 'trim_alphafold_cifs_journal.jsonl' in --outdir."
+        ),
+    )
+
+    parser.add_argument(
+        "-t", "--threshold",
+        type=float,
+        default=70,
+        help="The LDDT threshold to use for trimming low quality ends [1-100]. Default: 70"
+    )
+
+    parser.add_argument(
+        "-w", "--window",
+        type=int,
+        default=3,
+        help=(
+            "The size of the sliding window to use to remove low quality ends. "
+            "1 will stop trimming after encountering the first residue passing the threshold. "
+            "Default: 3."
+        )
+    )
+
+    parser.add_argument(
+        "--plant",
+        default=False,
+        action="store_true",
+        help="Should we run TargetP with the plant models? NB if sequences are a mix, use the plant model."
+    )
+
+    parser.add_argument(
+        "--targetp",
+        type=str,
+        nargs="?",
+        const="targetp",
+        default=None,
+        help=(
+            "Specify a specific path to look for the targetp2 executable. "
+            "By default it will not run targetp. If you specify '--targetp' but no path, it will look in your PATH."
+        )
+    )
+
+    parser.add_argument(
+        "--targetp-cache",
+        type=str,
+        default=None,
+        help=(
+            "An SQLite file to store TargetP predictions in. "
+            "Sequences that are already in the cache won't be run through TargetP again, "
+            "so it can be re-used for runs with different thresholds. "
+            "It will be created if it doesn't exist. "
+            "By default predictions aren't cached."
+        )
+    )
+
+    parser.add_argument(
+        "--targetp-workers",
+        type=int,
+        default=None,
+        help=(
+            "How many TargetP processes to run at once on each chunk. "
+            "The cores (or OMP_NUM_THREADS if it's set) are shared evenly between them. "
+            f"By default this is one process per {TARGETP_MAX_THREADS} cores, "
+            f"with at least {TARGETP_MIN_BATCH} sequences each."
+        )
+    )
+
+    parser.add_argument(
+        "--targetp-fifo",
+        default=False,
+        action="store_true",
+        help=(
+            "Give the sequences to TargetP through a named pipe rather than a temporary file. "
+            "This avoids writing the fasta to disk, but only works if your TargetP version "
+            "reads the fasta once from start to end."
+        )
+    )
+
+    parser.add_argument(
+        "--predictions",
+        type=str,
+        default=None,
+        help=(
+            "Use precomputed cleavage sites (e.g. from TargetP, SignalP6 or DeepTMHMM) instead of running TargetP. "
+            "A tab separated file with the protein id and the cleavage site in the first two columns, "
+            "where the cleavage site is the second number of TargetP's 'CS pos: X-Y' "
+            "(the same as the cs column of --report-only), "
+            "with an empty site (or '.', '-', 'NA') if there's no signal peptide. "
+            "AlphaFold ids are also looked up by their UniProt accession. "
+            "The table is indexed into an SQLite file the first time it's used, see --predictions-index."
+        )
+    )
+
+    parser.add_argument(
+        "--predictions-index",
+        type=str,
+        default=None,
+        help=(
+            "Where to keep the SQLite index of the --predictions table. "
+            "Use this if the table is somewhere you can't write to. "
+            "Default: '<predictions>.sqlite'."
+        )
+    )
+
+    parser.add_argument(
+        "-c", "--chunksize",
+        type=int,
+        default=1000,
+        help=(
+            "How many structures should we process at a time? "
+            "Running TargetP with too few or too many sequences (>5000) at a time is slow. "
+            "This is also important for memory consumption, as all of the structures have to be stored."
+            "Default: 1000"
+        )
+    )
+
+    parser.add_argument(
+        "--stats",
+        type=str,
+        default=None,
+        help=(
+            "Write timing and throughput statistics for each chunk to this file as JSON lines. "
+            "This includes the wall and CPU time of each stage (parse, trim, targetp, write), "
+            "counts of parsed, skipped and written structures, and residues and bytes per second."
+        )
+    )
+
+    parser.add_argument(
+        "--profile",
+        type=str,
+        default=None,
+        help=(
+            "Profile each chunk with cProfile, writing the results to "
+            "'chunk_NNNNNN.prof' files in this folder. "
+            "This processes one chunk at a time (i.e. --inflight 1), and with --threads "
+            "only the main process is profiled."
+        )
+    )
+
+    parser.add_argument(
+        "-m", "--minsize",
+        type=int,
+        default=10,
+        help="Filter out structures with fewer than this many AAs after trimming."
+    )
+
+    parser.add_argument(
+        "-p", "--threads",
+        type=int,
+        default=1,
+        help=(
+            "How many processes should we use to parse and write structures? "
+            "This doesn't affect TargetP, which uses OMP_NUM_THREADS. "
+            "Default: 1"
+        )
+    )
+
+    parser.add_argument(
+        "--inflight",
+        type=int,
+        default=3,
+        help=(
+            "How many chunks can be in progress at once? "
+            "With 3 or more, parsing and writing happen while TargetP is running. "
+            "Each chunk in flight takes up memory, so use 1 to process one chunk at a time. "
+            "Default: 3"
+        )
+    )
+
+
+    return parser.parse_args()
+
+
+def chunk_infiles(infiles, chunksize):
+    """ Split a stream of filenames into chunks of chunksize.
+
+    If there would be a really small chunk left over at the end
+    (less than a tenth of chunksize) it gets merged into the last chunk.
+    We only ever look ahead that far, so this works on streams of any length.
+    """
+    from itertools import islice
+
+    # I don't want any really small chunks left over at the end
+    minsize = round(chunksize / 10)
+
+    infiles = iter(infiles)
+    chunk = list(islice(infiles, chunksize))
+
+    while len(chunk) > 0:
+        lookahead = list(islice(infiles, minsize))
+
+        if len(lookahead) < minsize:
+            # We've hit the end, so the lookahead would be too small on its own.
+            chunk.extend(lookahead)
+            yield chunk
+            return
+
+        yield chunk
+        chunk = lookahead
+        chunk.extend(islice(infiles, chunksize - len(lookahead)))
+    return
+
+
+def main():
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+
+    args = cli()
+
+    if args.inflight < 1:
+        raise ValueError("--inflight must be at least 1.")
+
+    if (args.targetp_workers is not None) and (args.targetp_workers < 1):
+        raise ValueError("--targetp-workers must be at least 1.")
+
+    if (args.predictions is not None) and (args.targetp is not None):
+        raise ValueError("--predictions and --targetp can't be used together.")
+
+    if (args.predictions_index is not None) and (args.predictions is None):
+        raise ValueError("--predictions-index needs --predictions.")
+
+    if (args.report_only is not None) and (args.resume or (args.journal is not None) or (args.shards > 0)):
+        raise ValueError("--report-only can't be used with --resume, --journal, or --shards.")
+
+    if args.threads > 1:
+        # The workers are only started at the first submit, by which time
+        # the file listing thread is running. Forking a process with running
+        # threads can copy locks that are held, so start them from a clean
+        # server process instead.
+        executor = ProcessPoolExecutor(
+            max_workers=args.threads,
+            mp_context=multiprocessing.get_context("forkserver")
+        )
+    else:
+        executor = None
+
+    # Finding the files happens in the background, so we can start
+    # processing before a big directory has been completely listed.
+    infiles = in_background(iter_input_paths(args.infiles, suffixes=(".cif", ".cif.gz", ".tar")))
+
+    if args.report_only is not None:
+        # Nothing gets written to the output directory, so there's nothing to resume.
+        journal = None
+        report = open(args.report_only, "w")
+        report.write("\t".join(REPORT_COLUMNS) + "\n")
+    else:
+        makedirs(args.outdir, exist_ok=True)
+        remove_stale_partial_dirs(args.outdir)
+        report = None
+
+        if args.journal is not None:
+            journal = Journal(args.journal, args.resume)
+        elif args.resume:
+            journal = Journal(pjoin(args.outdir, "trim_alphafold_cifs_journal.jsonl"), args.resume)
+        else:
+            journal = None
+
+    infiles = expand_archives(infiles, suffixes=(".cif", ".cif.gz"))
+
+    if args.resume:
+        infiles = (f for f in infiles if not journal.is_done(f))
+
+    chunks = chunk_infiles(infiles, args.chunksize)
+
+    if args.shards > 0:
+        shards = ShardWriter(args.outdir, args.shards)
+    else:
+        shards = None
+
+    if args.targetp_cache is not None:
+        targetp_cache = TargetPCache(args.targetp_cache)
+    else:
+        targetp_cache = None
+
+    if args.predictions is not None:
+        predictions = PredictionTable(args.predictions, args.predictions_index)
+    else:
+        predictions = None
+
+    if args.stats is not None:
+        stats_handle = open(args.stats, "w")
+    else:
+        stats_handle = None
+
+    if args.profile is not None:
+        import cProfile
+        makedirs(args.profile, exist_ok=True)
+
+    if (args.inflight == 1) or (args.profile is not None):
+        for i, chunk in enumerate(chunks):
+            if args.profile is not None:
+                profiler = cProfile.Profile()
+                profiler.enable()
+
+            process_batch(
+                chunk,
+                args.outdir,
+                args.threshold,
+                args.window,
+                args.plant,
+                args.targetp,
+                args.minsize,
+                args.compress,
+                executor,
+                targetp_cache,
+                journal,
+                args.outformat,
+                shards,
+                ChunkStats(i, stats_handle),
+                args.targetp_workers,
+                args.targetp_fifo,
+                predictions,
+                report
+            )
+
+            if args.profile is not None:
+                profiler.disable()
+                profiler.dump_stats(pjoin(args.profile, f"chunk_{i:06d}.prof"))
+    else:
+        process_pipelined(
+            chunks,
+            args.outdir,
+            args.threshold,
+            args.window,
+            args.plant,
+            args.targetp,
+            args.minsize,
+            args.compress,
+            executor,
+            args.inflight,
+            targetp_cache,
+            journal,
+            args.outformat,
+            shards,
+            stats_handle,
+            args.targetp_workers,
+            args.targetp_fifo,
+            predictions,
+            report
+        )
+
+    if executor is not None:
+        executor.shutdown()
+
+    if targetp_cache is not None:
+        targetp_cache.close()
+
+    if predictions is not None:
+        predictions.close()
+
+    if shards is not None:
+        shards.close()
+
+    if stats_handle is not None:
+        stats_handle.close()
+
+    if report is not None:
+        report.close()
+
+    if journal is not None:
+        journal.close()
 
 
 if __name__ == "__main__":
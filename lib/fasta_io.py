@@ -0,0 +1,129 @@
+""" Fast fasta reading and writing for the python scripts in bin/.
+
+This works on bytes, and doesn't create an object per record like
+Bio.SeqIO does. Records are just (id, description, sequence) tuples.
+"""
+
+
+def binary_handle(handle):
+    """ Get the underlying binary stream of a text handle (e.g. sys.stdout).
+
+    Anything already written to the text layer is flushed first,
+    so the output stays in order.
+    """
+    if hasattr(handle, "buffer"):
+        handle.flush()
+        return handle.buffer
+    return handle
+
+
+def to_bytes(value) -> bytes:
+    if isinstance(value, str):
+        return value.encode()
+    return bytes(value)
+
+
+class FastaWriter(object):
+    """ A buffered fasta writer.
+
+    Records are formatted into a buffer and written to the handle in
+    large blocks. Sequences are wrapped at `wrap` characters per line,
+    or written on a single line if wrap is None or 0.
+    The handle can be a binary or a text file, and must be flushed
+    (or the writer closed) before the handle is.
+    """
+
+    def __init__(self, handle, wrap=60, buffer_size=1 << 16):
+        self.handle = binary_handle(handle)
+        self.wrap = wrap
+        self.buffer_size = buffer_size
+        self.buffer = []
+        self.buffered = 0
+        return
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.flush()
+        return
+
+    def format(self, id_, seq, desc=None) -> bytes:
+        id_ = to_bytes(id_)
+        seq = to_bytes(seq)
+
+        if desc:
+            header = b">" + id_ + b" " + to_bytes(desc) + b"\n"
+        else:
+            header = b">" + id_ + b"\n"
+
+        if (not self.wrap) or (len(seq) <= self.wrap):
+            if len(seq) == 0:
+                return header
+            return header + seq + b"\n"
+
+        wrap = self.wrap
+        lines = [seq[i:i + wrap] for i in range(0, len(seq), wrap)]
+        lines.append(b"")
+        return header + b"\n".join(lines)
+
+    def write(self, id_, seq, desc=None):
+        record = self.format(id_, seq, desc)
+        self.buffer.append(record)
+        self.buffered += len(record)
+
+        if self.buffered >= self.buffer_size:
+            self.flush()
+        return
+
+    def write_records(self, records):
+        """ Write an iterable of (id, description, sequence) tuples. """
+        for id_, desc, seq in records:
+            self.write(id_, seq, desc)
+        return
+
+    def flush(self):
+        if len(self.buffer) > 0:
+            self.handle.write(b"".join(self.buffer))
+            self.buffer = []
+            self.buffered = 0
+
+        self.handle.flush()
+        return
+
+    def close(self):
+        self.flush()
+        return
+
+
+def iter_fasta(handle):
+    """ Yield (id, description, sequence) tuples from a fasta.
+
+    The id and description are strings (the description is everything after
+    the first whitespace in the header, or an empty string), and the
+    sequence is bytes without any line breaks.
+    The handle can be a binary or a text file.
+    """
+    handle = getattr(handle, "buffer", handle)
+
+    id_ = None
+    desc = ""
+    chunks = []
+
+    for line in handle:
+        if line.startswith(b">"):
+            if id_ is not None:
+                yield id_, desc, b"".join(chunks)
+
+            header = line[1:].strip().split(None, 1)
+            id_ = header[0].decode() if len(header) > 0 else ""
+            desc = header[1].decode() if len(header) > 1 else ""
+            chunks = []
+        elif id_ is not None:
+            chunks.append(line.rstrip())
+        elif line.strip() != b"":
+            raise ValueError("The fasta file should start with a '>' header line.")
+
+    if id_ is not None:
+        yield id_, desc, b"".join(chunks)
+    return
@@ -0,0 +1,412 @@
+""" Shared file handling for the structure scripts in bin/.
+
+The scripts add this directory to sys.path, the same way that the shell
+scripts find lib/ relative to the bin/ directory.
+"""
+
+import io
+import tarfile
+from contextlib import contextmanager
+from functools import lru_cache
+
+# Use a faster zlib implementation if one is installed.
+# Both of these are drop in replacements for the gzip module.
+try:
+    from isal import igzip as gzip
+except ImportError:
+    try:
+        from zlib_ng import gzip_ng as gzip
+    except ImportError:
+        import gzip
+
+
+GZIP_MAGIC = b"\x1f\x8b"
+
+# Members of tar archives are given as "archive.tar::path/to/member".
+ARCHIVE_SEP = "::"
+
+
+def is_gzipped(handle) -> bool:
+    """ Check the magic bytes of a binary handle without consuming them. """
+    if hasattr(handle, "peek"):
+        return handle.peek(2)[:2] == GZIP_MAGIC
+
+    position = handle.tell()
+    magic = handle.read(2)
+    handle.seek(position)
+    return magic == GZIP_MAGIC
+
+
+def split_archive_path(path):
+    """ Split "archive.tar::member" into the archive and member.
+
+    The member is None for ordinary paths.
+    """
+    if ARCHIVE_SEP in path:
+        archive, member = path.split(ARCHIVE_SEP, 1)
+        return archive, member
+    return path, None
+
+
+def path_basename(path) -> str:
+    """ The file name of a path, or of the member for "archive.tar::member". """
+    from os.path import basename
+
+    _, member = split_archive_path(path)
+    return basename(path if member is None else member)
+
+
+def is_archive(path) -> bool:
+    return path.endswith(".tar") and (ARCHIVE_SEP not in path)
+
+
+def iter_archive_members(archive, suffixes):
+    """ Yield "archive.tar::member" paths for files ending with one of suffixes.
+
+    The archive headers are read one at a time, so this starts yielding
+    paths straight away even for really big archives.
+    """
+    suffixes = tuple(suffixes)
+    with tarfile.open(archive, mode="r:") as tar:
+        for info in tar:
+            if info.isfile() and info.name.endswith(suffixes):
+                yield f"{archive}{ARCHIVE_SEP}{info.name}"
+
+            # Don't keep all of the headers in memory.
+            tar.members = []
+    return
+
+
+def expand_archives(paths, suffixes):
+    """ Replace any tar archives in a stream of paths with their members. """
+    for path in paths:
+        if is_archive(path):
+            yield from iter_archive_members(path, suffixes)
+        else:
+            yield path
+    return
+
+
+GLOB_CHARS = set("*?[")
+
+
+def walk_files(root, suffixes):
+    """ Recursively yield the files under root that end with one of suffixes.
+
+    This uses os.scandir, which gets the file types from the directory
+    listing rather than calling stat on every file. The entries in each
+    directory are sorted, so the order is the same every time.
+    Symbolic links to directories aren't followed (like find).
+    """
+    import os
+
+    suffixes = tuple(suffixes)
+    stack = [root]
+    while len(stack) > 0:
+        directory = stack.pop()
+
+        with os.scandir(directory) as it:
+            entries = sorted(it, key=lambda e: e.name)
+
+        subdirectories = []
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                subdirectories.append(entry.path)
+            elif entry.name.endswith(suffixes) and entry.is_file():
+                yield entry.path
+
+        # Reversed so that they're popped in sorted order.
+        stack.extend(reversed(subdirectories))
+    return
+
+
+def iter_glob(pattern, suffixes):
+    """ Yield the files matching a glob pattern, searching any directories it matches.
+
+    The matches are yielded as they are found rather than sorted, so this
+    starts straight away for big directories.
+    Recursive patterns (e.g. 'structures/**') match a directory and everything
+    under it, so anything inside a directory we've already searched is skipped.
+    """
+    import os
+    from glob import iglob
+
+    suffixes = tuple(suffixes)
+    searched = set()
+
+    for path in iglob(pattern, recursive=True):
+        path = os.path.normpath(path)
+
+        # iglob is top down, so any directory containing this one comes first.
+        parent = os.path.dirname(path)
+        while parent not in searched:
+            next_parent = os.path.dirname(parent)
+            if next_parent == parent:
+                break
+            parent = next_parent
+
+        if parent in searched:
+            continue
+
+        if os.path.isdir(path):
+            searched.add(path)
+            yield from walk_files(path, suffixes)
+        elif path.endswith(suffixes):
+            yield path
+    return
+
+
+def iter_input_paths(inputs, suffixes, stdin=None):
+    """ Turn the command line inputs into a stream of file paths.
+
+    Each input can be:
+    - a directory, which is searched recursively for files ending with suffixes,
+    - a glob pattern (e.g. 'structures/**/*.cif.gz'), where any directories
+      it matches are searched like above,
+    - a file ending with one of suffixes, which is used as is,
+    - '-' or any other file, which is read as a new-line delimited list of paths.
+    """
+    import os
+
+    suffixes = tuple(suffixes)
+
+    for input_ in inputs:
+        if input_ == "-":
+            if stdin is None:
+                import sys
+                stdin = sys.stdin
+            yield from (l.strip() for l in stdin if l.strip() != "")
+        elif os.path.isdir(input_):
+            yield from walk_files(input_, suffixes)
+        elif (not os.path.exists(input_)) and (len(GLOB_CHARS.intersection(input_)) > 0):
+            yield from iter_glob(input_, suffixes)
+        elif input_.endswith(suffixes):
+            yield input_
+        else:
+            with open(input_) as handle:
+                yield from (l.strip() for l in handle if l.strip() != "")
+    return
+
+
+def in_background(iterable, maxsize=10000):
+    """ Run an iterable (e.g. a directory walk) in a thread, yielding its items.
+
+    The items are passed through a bounded queue, so the iterable can get
+    ahead of whatever is consuming them, but not by more than maxsize items.
+    Errors in the thread are raised here.
+    """
+    from queue import Queue, Full
+    from threading import Thread, Event
+
+    done = object()
+    queue = Queue(maxsize=maxsize)
+    stop = Event()
+
+    def put(item):
+        # Check every so often if the consumer has gone away.
+        while not stop.is_set():
+            try:
+                queue.put(item, timeout=0.1)
+                return True
+            except Full:
+                continue
+        return False
+
+    def run():
+        try:
+            for item in iterable:
+                if not put((None, item)):
+                    return
+        except BaseException as e:
+            put((e, None))
+            return
+        put((None, done))
+        return
+
+    thread = Thread(target=run, daemon=True)
+    thread.start()
+
+    try:
+        while True:
+            error, item = queue.get()
+            if error is not None:
+                raise error
+            elif item is done:
+                break
+            yield item
+    finally:
+        # The thread is a daemon, so we don't wait for it here in case
+        # it's stuck waiting for input (e.g. from stdin).
+        stop.set()
+    return
+
+
+@lru_cache(maxsize=8)
+def archive_index(archive):
+    """ Map member names to the offset and size of their data.
+
+    This is cached, so each process only reads the headers of an archive once.
+    """
+    index = dict()
+    with tarfile.open(archive, mode="r:") as tar:
+        for info in tar:
+            if info.isfile():
+                index[info.name] = (info.offset_data, info.size)
+            tar.members = []
+    return index
+
+
+def read_archive_member(archive, member) -> bytes:
+    try:
+        offset, size = archive_index(archive)[member]
+    except KeyError:
+        raise ValueError(f"{member} is not in the archive {archive}.")
+
+    with open(archive, "rb") as handle:
+        handle.seek(offset)
+        return handle.read(size)
+
+
+def input_size(filename) -> int:
+    """ The size on disk (i.e. compressed) of a file or archive member. """
+    from os.path import getsize
+
+    archive, member = split_archive_path(filename)
+
+    if member is None:
+        return getsize(filename)
+
+    _, size = archive_index(archive)[member]
+    return size
+
+
+def open_raw(filename):
+    """ Open a file or archive member for reading bytes, without decompressing. """
+    archive, member = split_archive_path(filename)
+
+    if member is None:
+        return open(filename, "rb")
+
+    # Archive members are small, so we just read the (still compressed)
+    # data into memory rather than extracting it anywhere.
+    return io.BytesIO(read_archive_member(archive, member))
+
+
+@contextmanager
+def open_binary(filename):
+    """ Open a possibly gzipped file as a stream of decompressed bytes.
+
+    The file is only opened once, we check the magic bytes on the same
+    handle that we decompress from.
+    Members of tar archives can be given as "archive.tar::member".
+    """
+    with open_raw(filename) as handle:
+        if is_gzipped(handle):
+            with gzip.GzipFile(fileobj=handle, mode="rb") as zhandle:
+                yield zhandle
+        else:
+            yield handle
+    return
+
+
+@contextmanager
+def open_text(filename, encoding="utf-8"):
+    """ Open a possibly gzipped file as a text stream.
+
+    The decompressed text is decoded as it is read rather than being read
+    into memory all at once, so the parsers can stream through it.
+    """
+    with open_binary(filename) as handle:
+        text = io.TextIOWrapper(handle, encoding=encoding)
+        try:
+            yield text
+        finally:
+            # Stop the wrapper from closing the underlying handle,
+            # open_binary deals with that.
+            text.detach()
+    return
+
+
+def iter_cif_categories(lines, categories):
+    """ Only pass on the lines of an mmCIF file that belong to some categories.
+
+    This sits between a text handle and MMCIF2Dict, so that the (slow)
+    tokeniser never sees the categories we don't want, like _atom_site.
+    The categories are given with their leading underscore (e.g. "_entity_poly").
+    Once all of the requested categories have been passed, we stop reading
+    the file.
+    """
+    categories = set(categories)
+    finished = set()
+
+    current = None
+    keep = False
+    in_text = False
+    loop = False
+
+    for line in lines:
+        # Semicolon delimited text fields belong to the item before them.
+        if in_text:
+            if keep:
+                yield line
+            if line.startswith(";"):
+                in_text = False
+            continue
+        elif line.startswith(";"):
+            in_text = True
+            if keep:
+                yield line
+            continue
+
+        if line.startswith("data_"):
+            yield line
+            continue
+
+        stripped = line.lstrip()
+        if stripped.startswith("loop_"):
+            # We don't know which category the loop is for until the next line.
+            loop = True
+            continue
+
+        if stripped.startswith("_"):
+            category = stripped.split(".", 1)[0]
+
+            if category != current:
+                if current in categories:
+                    finished.add(current)
+
+                    if finished >= categories:
+                        return
+
+                current = category
+                keep = category in categories
+
+            if loop and keep:
+                yield "loop_\n"
+
+            loop = False
+
+        if keep:
+            yield line
+    return
+
+
+def read_mmcif_dict(filename, categories=None):
+    """ Parse an mmCIF file, optionally only the given categories.
+
+    The file can be gzipped, or a member of an archive.
+    """
+    from Bio.PDB.MMCIF2Dict import MMCIF2Dict
+
+    with open_text(filename) as handle:
+        if categories is None:
+            return MMCIF2Dict(handle)
+        return MMCIF2Dict(iter_cif_categories(handle, categories))
+
+
+def open_output(filename, compress=False, mode="wb"):
+    """ Open a file for writing, gzip compressing it if requested. """
+    if compress:
+        return gzip.open(filename, mode)
+    else:
+        return open(filename, mode)
@@ -0,0 +1,39 @@
+""" Helpers shared by the tests.
+
+The scripts in bin/ aren't a package, so they're loaded from their files.
+bench/generate.py is used to make the test structures.
+"""
+
+import sys
+import importlib.util
+from os.path import dirname, realpath
+from os.path import join as pjoin
+
+ROOT_DIR = dirname(dirname(realpath(__file__)))
+BIN_DIR = pjoin(ROOT_DIR, "bin")
+BENCH_DIR = pjoin(ROOT_DIR, "bench")
+
+sys.path.insert(0, BENCH_DIR)
+import generate  # noqa: E402,F401
+
+
+def load_script(name):
+    """ Import one of the scripts in bin/ as a module. """
+    spec = importlib.util.spec_from_file_location(
+        name.replace(".py", ""),
+        pjoin(BIN_DIR, name)
+    )
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def read_dir(directory):
+    """ Map the file names in a directory to their contents. """
+    import os
+
+    out = dict()
+    for name in sorted(os.listdir(directory)):
+        with open(pjoin(directory, name), "rb") as handle:
+            out[name] = handle.read()
+    return out
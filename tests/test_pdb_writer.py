@@ -0,0 +1,180 @@
+""" Check that the structure writer gives the same files as Biopython.
+
+The trimmed structures used to be written with MMCIFParser and PDBIO,
+selecting residues with MMCIFSelect. The new writer formats the _atom_site
+records directly, and should give byte for byte identical PDB files.
+
+Run with `python -m pytest tests/`, or directly with `python tests/test_pdb_writer.py`.
+"""
+
+import random
+import tempfile
+from io import StringIO
+from os.path import join as pjoin
+
+from Bio.PDB import MMCIFParser, PDBIO, Select
+from Bio.PDB.MMCIF2Dict import MMCIF2Dict
+
+from common import generate, load_script
+
+trim = load_script("trim_alphafold_cifs.py")
+
+
+class MMCIFSelect(Select):
+    """ The selection the trimmed structures were originally written with. """
+
+    def __init__(self, start, end):
+        self.start = start
+        self.end = end
+        self.selected = False
+        return
+
+    def accept_chain(self, chain):
+        # Just in case there are multiple chains, we only take the first.
+        if self.selected:
+            return 0
+        else:
+            self.selected = True
+            return 1
+
+    def accept_residue(self, residue):
+
+        _, index, _ = residue.get_id()
+        index -= 1
+
+        if index < self.start:
+            return 0
+        elif index >= self.end:
+            return 0
+        else:
+            return 1
+
+
+def biopython_pdb(filename, ltrim, rtrim):
+    parser = MMCIFParser(QUIET=True)
+    structure = parser.get_structure("test", filename)
+
+    writer = PDBIO()
+    writer.set_structure(structure)
+
+    sio = StringIO()
+    writer.save(sio, MMCIFSelect(ltrim, rtrim))
+    return sio.getvalue()
+
+
+def new_pdb(filename, ltrim, rtrim):
+    d = MMCIF2Dict(filename)
+    return "".join(trim.iter_trimmed_lines("test", trim.pack_atom_site(d), ltrim, rtrim, "pdb"))
+
+
+def check_same(filename, ltrim, rtrim):
+    expected = biopython_pdb(filename, ltrim, rtrim)
+    got = new_pdb(filename, ltrim, rtrim)
+    assert got == expected, (filename, ltrim, rtrim)
+    return
+
+
+def structures(tmpdir, n, profile, seed):
+    return generate.write_structures(
+        pjoin(tmpdir, profile),
+        n,
+        min_length=20,
+        max_length=150,
+        profile=profile,
+        seed=seed
+    )
+
+
+def test_lddt_trims():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        cifs = structures(tmpdir, 20, "ends", 11)
+        cifs.extend(structures(tmpdir, 10, "noisy", 12))
+
+        for cif in cifs:
+            mm = trim.MMCIFData.read(cif, atom_site=False, lddt_threshold=70, lddt_window_size=5)
+            check_same(cif, mm.left_trim, mm.right_trim)
+    return
+
+
+def test_random_trims():
+    rng = random.Random(5)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for cif in structures(tmpdir, 10, "ends", 21):
+            length = len(trim.MMCIFData.read(cif, atom_site=False).seq)
+
+            for _ in range(5):
+                ltrim = rng.randint(0, length)
+                rtrim = rng.randint(ltrim, length + 2)
+                check_same(cif, ltrim, rtrim)
+    return
+
+
+def test_wrapped_left_trim():
+    # When the whole profile is high trim_lddt_left wraps around to -1,
+    # which should still keep everything from the first residue.
+    with tempfile.TemporaryDirectory() as tmpdir:
+        nwrapped = 0
+        for cif in structures(tmpdir, 10, "high", 31):
+            mm = trim.MMCIFData.read(cif, atom_site=False, lddt_threshold=70, lddt_window_size=5)
+            nwrapped += mm.left_trim == -1
+            check_same(cif, mm.left_trim, mm.right_trim)
+            check_same(cif, -1, len(mm.seq))
+
+        assert nwrapped > 0, "None of the test structures had a left trim of -1."
+    return
+
+
+def test_empty_selection():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for cif in structures(tmpdir, 3, "ends", 41):
+            length = len(trim.MMCIFData.read(cif, atom_site=False).seq)
+
+            for ltrim, rtrim in [(0, 0), (10, 10), (10, 5), (length, length + 5)]:
+                check_same(cif, ltrim, rtrim)
+                assert new_pdb(cif, ltrim, rtrim) == "END   \n"
+    return
+
+
+def test_packed_trims():
+    # The workers only keep the atoms inside the trims, which should
+    # write the same files as cutting the full _atom_site records.
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for cif in structures(tmpdir, 10, "ends", 51):
+            mm = trim.MMCIFData.read(cif, lddt_threshold=70, lddt_window_size=5)
+            got = "".join(trim.iter_trimmed_lines(mm.id, mm.atom_site, mm.left_trim, mm.right_trim, "pdb"))
+            assert got == biopython_pdb(cif, mm.left_trim, mm.right_trim), cif
+    return
+
+
+def test_cif_round_trip():
+    # Trimmed mmCIF files should read back as the same atoms,
+    # so that converting them to PDB gives the trimmed PDB file.
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for i, cif in enumerate(structures(tmpdir, 10, "ends", 61)):
+            mm = trim.MMCIFData.read(cif, atom_site=False, lddt_threshold=70, lddt_window_size=5)
+            atoms = trim.pack_atom_site(MMCIF2Dict(cif))
+
+            outfile = pjoin(tmpdir, f"trimmed{i}.cif")
+            trim.write_trimmed_structure(outfile, mm.id, atoms, mm.left_trim, mm.right_trim, outformat="cif")
+
+            trimmed = MMCIF2Dict(outfile)
+            assert trimmed["data_"] == mm.id
+
+            full = trim.unpack_atom_site(atoms)
+            rows = trim.select_atom_rows(full, mm.left_trim, mm.right_trim)
+            for key, values in full.items():
+                assert trimmed[key] == [values[j] for j in rows], (cif, key)
+
+            assert biopython_pdb(outfile, -1, len(mm.seq)) == biopython_pdb(cif, mm.left_trim, mm.right_trim)
+    return
+
+
+if __name__ == "__main__":
+    test_lddt_trims()
+    test_random_trims()
+    test_wrapped_left_trim()
+    test_empty_selection()
+    test_packed_trims()
+    test_cif_round_trip()
+    print("OK")
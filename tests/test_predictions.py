@@ -0,0 +1,96 @@
+""" Check that --predictions gives the same structures as --targetp.
+
+A table made from TargetP's own output (the second number of 'CS pos: X-Y')
+should trim the structures exactly like running TargetP does.
+
+Run with `python -m pytest tests/`, or directly with `python tests/test_predictions.py`.
+"""
+
+import re
+import subprocess
+import tempfile
+from contextlib import redirect_stdout
+from io import StringIO
+from os.path import join as pjoin
+
+from common import generate, load_script, read_dir
+
+trim = load_script("trim_alphafold_cifs.py")
+
+CS_POS = re.compile(r"CS pos: \d+-(?P<cs>\d+)")
+
+
+def targetp_table(targetp, cifs, filename):
+    """ Run TargetP on the structures and write the cleavage sites as a table. """
+    fasta = f"{filename}.fasta"
+    with open(fasta, "w") as handle:
+        for cif in cifs:
+            mm = trim.MMCIFData.read(cif, atom_site=False)
+            handle.write(f">{mm.id}\n{mm.seq}\n")
+
+    output = subprocess.run(
+        [targetp, "-fasta", fasta, "-org", "non-pl", "-stdout"],
+        check=True,
+        capture_output=True,
+        text=True
+    ).stdout
+
+    nsites = 0
+    with open(filename, "w") as handle:
+        handle.write("id\tcs\n")
+        for line in output.splitlines():
+            if line.startswith("#"):
+                continue
+
+            id_ = line.split("\t", 1)[0]
+            match = CS_POS.search(line)
+            if match is None:
+                handle.write(f"{id_}\t\n")
+            else:
+                handle.write(f"{id_}\t{match['cs']}\n")
+                nsites += 1
+    return nsites
+
+
+def run(cifs, outdir, targetp, predictions=None):
+    with redirect_stdout(StringIO()):
+        trim.process_batch(
+            cifs,
+            outdir,
+            70,
+            5,
+            False,
+            targetp,
+            10,
+            predictions=predictions
+        )
+    return read_dir(outdir)
+
+
+def test_targetp_table_matches_targetp():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        cifs = generate.write_structures(pjoin(tmpdir, "cifs"), 30, seed=3)
+        targetp = generate.write_fake_targetp(pjoin(tmpdir, "targetp"))
+
+        table = pjoin(tmpdir, "predictions.tsv")
+        nsites = targetp_table(targetp, cifs, table)
+        assert nsites > 0, "None of the test structures have a signal peptide."
+
+        expected = run(cifs, pjoin(tmpdir, "targetp_out"), targetp)
+
+        predictions = trim.PredictionTable(table)
+        try:
+            got = run(cifs, pjoin(tmpdir, "predictions_out"), targetp, predictions)
+        finally:
+            predictions.close()
+
+    assert len(expected) > 0
+    assert got.keys() == expected.keys()
+    for name in expected:
+        assert got[name] == expected[name], name
+    return
+
+
+if __name__ == "__main__":
+    test_targetp_table_matches_targetp()
+    print("OK")
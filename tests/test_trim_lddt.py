@@ -0,0 +1,95 @@
+""" Check that trim_lddt_batch agrees with trim_lddt_left and trim_lddt_right.
+
+Run with `python -m pytest tests/`, or directly with `python tests/test_trim_lddt.py`.
+The inputs are random but seeded, so every run checks the same cases.
+"""
+
+import random
+
+from common import load_script
+
+trim = load_script("trim_alphafold_cifs.py")
+
+
+def random_profile(rng, length, threshold):
+    """ A random LDDT profile, with lots of values right on the threshold. """
+    kind = rng.choice(["uniform", "integers", "ties", "blocks"])
+
+    if kind == "uniform":
+        return [rng.uniform(0, 100) for _ in range(length)]
+    elif kind == "integers":
+        return [float(rng.randint(0, 100)) for _ in range(length)]
+    elif kind == "ties":
+        return [
+            rng.choice([threshold, threshold - 0.1, threshold + 0.1, 0.0, 100.0])
+            for _ in range(length)
+        ]
+
+    # Runs of high and low values, like real disordered ends.
+    out = []
+    while len(out) < length:
+        value = rng.choice([rng.uniform(90, 100), rng.uniform(20, 50), threshold])
+        out.extend([value] * rng.randint(1, 10))
+    return out[:length]
+
+
+def check_batch(lddts, threshold, window_size):
+    lefts, rights = trim.trim_lddt_batch(lddts, threshold=threshold, window_size=window_size)
+
+    for lddt, left, right in zip(lddts, lefts.tolist(), rights.tolist()):
+        expected_left = trim.trim_lddt_left(lddt, threshold=threshold, window_size=window_size)
+        expected_right = trim.trim_lddt_right(lddt, threshold=threshold, window_size=window_size)
+
+        assert left == expected_left, (lddt, threshold, window_size, left, expected_left)
+        assert right == expected_right, (lddt, threshold, window_size, right, expected_right)
+    return
+
+
+def test_random_profiles():
+    rng = random.Random(20240101)
+
+    for _ in range(300):
+        threshold = rng.choice([70, 50, 90, 0, 100, round(rng.uniform(1, 99), 1)])
+        window_size = rng.choice([1, 2, 3, 5, 5, 10, 25])
+
+        # Mixed length batches, including profiles shorter than the window.
+        lddts = [
+            random_profile(rng, rng.randint(1, 60), threshold)
+            for _ in range(rng.randint(1, 20))
+        ]
+        check_batch(lddts, threshold, window_size)
+    return
+
+
+def test_window_longer_than_profile():
+    for window_size in (1, 2, 5, 10):
+        for length in range(1, 12):
+            for value in (0.0, 70.0, 100.0):
+                check_batch([[value] * length], 70, window_size)
+    return
+
+
+def test_single_profiles():
+    # The same profiles on their own, so that no padding is involved.
+    rng = random.Random(42)
+
+    for _ in range(500):
+        threshold = rng.choice([70, 50, 90])
+        window_size = rng.randint(1, 8)
+        check_batch([random_profile(rng, rng.randint(1, 30), threshold)], threshold, window_size)
+    return
+
+
+def test_empty_batch():
+    lefts, rights = trim.trim_lddt_batch([])
+    assert len(lefts) == 0
+    assert len(rights) == 0
+    return
+
+
+if __name__ == "__main__":
+    test_random_profiles()
+    test_window_longer_than_profile()
+    test_single_profiles()
+    test_empty_batch()
+    print("OK")